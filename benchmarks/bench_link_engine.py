@@ -0,0 +1,80 @@
+"""リンク書き換えエンジンのマイクロベンチマーク
+
+    python benchmarks/bench_link_engine.py [--number 20000]
+
+メッセージの種類ごとに rewrite_youtube_links / remove_emojis の1メッセージあたりの処理時間を計測する。
+比較用に、以前の実装（パターンごとに re.search、str.replace を複数回、毎回 re.compile）も計測する。
+"""
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord_to_misskey as bot
+
+SAMPLE_MESSAGES = {
+    'テキストのみ': '今日は良い天気でした。\n散歩して帰ってきました。' * 4,
+    'shorts 1件': 'これ好き https://youtube.com/shorts/dQw4w9WgXcQ?si=AbCdEfGhIjKlMnOp',
+    'watch 追加パラメータ': '【https://www.youtube.com/watch?feature=share&v=dQw4w9WgXcQ&t=42s】 見て',
+    '複数リンク': '\n'.join([
+        'https://youtu.be/dQw4w9WgXcQ',
+        'https://m.youtube.com/watch?v=9bZkp7q1971',
+        'https://music.youtube.com/watch?v=kJQP7kiw5Fk&list=RDAMVM',
+        'https://www.youtube.com/shorts/3JZ_D3ELwOQ',
+    ]),
+}
+
+LEGACY_PATTERNS = [
+    r'https?://(?:www\.)?youtube\.com/shorts/([a-zA-Z0-9_-]+)',
+    r'https?://(?:www\.)?youtube\.com/watch\?v=([a-zA-Z0-9_-]+)',
+    r'https?://(?:www\.)?youtu\.be/([a-zA-Z0-9_-]+)'
+]
+
+def legacy_rewrite(text: str) -> tuple[str, str | None]:
+    """以前の実装相当（ログ出力は除く）"""
+    video_id = None
+    for pattern in LEGACY_PATTERNS:
+        re.compile(pattern)
+        match = re.search(pattern, text)
+        if match:
+            video_id = match.group(1)
+            break
+    if not video_id:
+        return text, None
+    modified_text = text
+    for url in [f"https://youtube.com/shorts/{video_id}", f"https://www.youtube.com/shorts/{video_id}", f"https://youtu.be/{video_id}"]:
+        if url in modified_text:
+            modified_text = modified_text.replace(url, "").replace(f"【{url}】", "")
+            break
+    modified_text = re.sub(r'\?si=[a-zA-Z0-9_-]+', '', modified_text)
+    return modified_text.replace('\n\n\n', '\n').replace('\n\n', '\n').strip(), video_id
+
+def legacy_remove_emojis(text: str) -> str:
+    emoji_pattern = re.compile(bot.EMOJI_RE.pattern, flags=re.UNICODE)
+    return emoji_pattern.sub('', text).strip()
+
+def measure(func, arg, number: int) -> float:
+    """1回あたりの処理時間（マイクロ秒）"""
+    return min(timeit.repeat(lambda: func(arg), number=number, repeat=3)) / number * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=20000, help='1計測あたりの実行回数')
+    args = parser.parse_args()
+    
+    print(f"{'メッセージ':<20} {'新エンジン(µs)':>14} {'旧実装(µs)':>12} {'検出ID'}")
+    for name, text in SAMPLE_MESSAGES.items():
+        new_cost = measure(bot.rewrite_youtube_links, text, args.number)
+        old_cost = measure(legacy_rewrite, text, args.number)
+        _, video_ids = bot.rewrite_youtube_links(text)
+        print(f"{name:<20} {new_cost:>14.2f} {old_cost:>12.2f} {video_ids}")
+    
+    title = '🎵 Never Gonna Give You Up 🎬 (Official Video) ✨'
+    print(f"{'remove_emojis':<20} {measure(bot.remove_emojis, title, args.number):>14.2f} "
+          f"{measure(legacy_remove_emojis, title, args.number):>12.2f}")
+
+if __name__ == '__main__':
+    main()
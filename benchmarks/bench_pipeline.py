@@ -0,0 +1,178 @@
+"""投稿パイプライン全体の負荷試験（実際のDiscord・Misskeyは不要）
+
+    python benchmarks/bench_pipeline.py [--messages 200] [--rate 0] [--latency 0.05] [--rate-limit-ratio 0.05]
+
+fake_misskey.py の代用サーバーを同じプロセスで起動し、合成したメッセージを on_message に流し込む。
+ワークロード（テキストのみ・YouTubeリンク・複数添付）ごとに、スループット、
+on_message からジョブ完了までのレイテンシ（p50/p99）、ピークメモリ（tracemalloc）を表示する。
+ピークメモリには同じプロセスで動かしている代用サーバーの分も含まれるため、Bot単体よりも大きめに出る。
+QUEUE_WORKERS や UPLOAD_CONCURRENCY などBotの設定は環境変数でそのまま変更できる。
+"""
+import argparse
+import asyncio
+import importlib
+import itertools
+import math
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_misskey import FakeMisskey, start_fake_server
+
+CHANNEL_ID = 1000
+USER_ID = 2000
+WORKLOADS = ('text', 'youtube', 'attachments')
+SENTENCES = [
+    '今日は良い天気でした。',
+    '散歩して帰ってきました。',
+    '新しい曲を聴いています。',
+    '明日の配信の準備をしています。',
+]
+VIDEO_IDS = ['dQw4w9WgXcQ', '9bZkp7q1971', 'kJQP7kiw5Fk', '3JZ_D3ELwOQ', 'OPf0YbXqDm0', 'JGwWNGJdvx8']
+attachment_ids = itertools.count(1)
+
+def free_port() -> int:
+    """空いているTCPポートを取得"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def make_message(message_id: int, workload: str, base_url: str, attachment_size: int) -> SimpleNamespace:
+    """on_message に渡す合成メッセージ（discord.Message のうちBotが使う属性だけ持つ）"""
+    content = ''.join(random.choices(SENTENCES, k=4))
+    attachments = []
+    if workload == 'youtube':
+        content += ' ' + ' '.join(f"https://youtu.be/{video_id}" for video_id in random.sample(VIDEO_IDS, 2))
+    elif workload == 'attachments':
+        attachments = [
+            SimpleNamespace(id=next(attachment_ids), url=f"{base_url}/cdn/{message_id}-{i}.png?size={attachment_size}",
+                            filename=f"{message_id}-{i}.png", size=attachment_size, content_type='image/png')
+            for i in range(3)
+        ]
+    return SimpleNamespace(
+        id=message_id,
+        channel=SimpleNamespace(id=CHANNEL_ID),
+        author=SimpleNamespace(id=USER_ID, bot=False),
+        content=content,
+        attachments=attachments,
+    )
+
+def percentile(values: list[float], p: float) -> float:
+    """最近傍法のパーセンタイル"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p * len(ordered)) - 1)]
+
+async def run_workload(bot, workload: str, args, base_url: str) -> dict:
+    """1つのワークロードを流し、完了まで待って結果を返す"""
+    started_at: dict[int, float] = {}
+    latencies: list[float] = []
+    done = asyncio.Event()
+    process_job = bot.process_job
+    
+    async def timed_process_job(job_id: int, payload: dict):
+        await process_job(job_id, payload)
+        latencies.append(time.perf_counter() - started_at[payload['message_id']])
+        if len(latencies) == args.messages:
+            done.set()
+    
+    bot.process_job = timed_process_job
+    requests_before = sum(dest.stats['requests'] for dest in bot.misskey_clients.values())
+    throttled_before = sum(dest.stats['throttled'] for dest in bot.misskey_clients.values())
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        base_id = bot.discord.utils.time_snowflake(bot.discord.utils.utcnow())
+        for i in range(args.messages):
+            message = make_message(base_id + i, workload, base_url, args.attachment_size)
+            started_at[message.id] = time.perf_counter()
+            await bot.on_message(message)
+            if args.rate:
+                await asyncio.sleep(1 / args.rate)
+        await asyncio.wait_for(done.wait(), timeout=args.timeout)
+    finally:
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        bot.process_job = process_job
+    
+    return {
+        'workload': workload,
+        'messages': len(latencies),
+        'elapsed_s': elapsed,
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_mb': peak / 1024 / 1024,
+        'requests': sum(dest.stats['requests'] for dest in bot.misskey_clients.values()) - requests_before,
+        'throttled': sum(dest.stats['throttled'] for dest in bot.misskey_clients.values()) - throttled_before,
+    }
+
+async def run(args):
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    # 状態のDBは一時ディレクトリに作り、終了時にディレクトリごと削除する
+    with tempfile.TemporaryDirectory(prefix='bench_pipeline_') as state_dir:
+        # Botの設定は読み込み時に決まるので、インポート前に代用サーバーを向ける
+        os.environ.update({
+            'DISCORD_BOT_TOKEN': 'benchmark',
+            'MISSKEY_HOST': base_url,
+            'MISSKEY_TOKEN': 'benchmark',
+            'TARGET_CHANNEL_IDS': str(CHANNEL_ID),
+            'MY_USER_ID': str(USER_ID),
+            'YOUTUBE_API_KEY': 'benchmark',
+            'BOT_DB_PATH': os.path.join(state_dir, 'bot_state.db'),
+            'METRICS_PORT': '0',
+        })
+        # 計測したいのはBot側の処理なので、クライアント側のレート制限は明示しない限り緩めておく
+        os.environ.setdefault('MISSKEY_RATE_LIMIT', '1000')
+        os.environ.setdefault('MISSKEY_RATE_BURST', '1000')
+        os.environ.setdefault('LOG_LEVEL', 'ERROR')
+        bot = importlib.import_module('discord_to_misskey')
+        bot.YOUTUBE_API_URL = f"{base_url}/youtube/v3/videos"
+        bot.logger.setLevel(os.environ['LOG_LEVEL'])
+        
+        fake = FakeMisskey(args.latency, args.jitter, args.rate_limit_ratio, args.retry_after, args.upload_bandwidth)
+        runner, _ = await start_fake_server(fake, port=port)
+        bot.start_queue_workers()
+        try:
+            print(f"{'ワークロード':<12} {'件数':>5} {'時間(s)':>8} {'件/s':>8} {'p50(ms)':>9} {'p99(ms)':>9} "
+                  f"{'ピーク(MB)':>10} {'API呼出':>8} {'429':>5}")
+            for workload in args.workloads:
+                result = await run_workload(bot, workload, args, base_url)
+                print(f"{result['workload']:<12} {result['messages']:>5} {result['elapsed_s']:>8.2f} {result['throughput']:>8.1f} "
+                      f"{result['p50_ms']:>9.1f} {result['p99_ms']:>9.1f} {result['peak_mb']:>10.2f} "
+                      f"{result['requests']:>8} {result['throttled']:>5}")
+            print(f"最大RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+            print("※ ピークメモリ・最大RSSには同じプロセスで動かしている代用サーバーの分も含まれます")
+        finally:
+            await bot.stop_queue_workers()
+            await bot.close_misskey_clients()
+            await bot.close_http_session()
+            bot.close_db()
+            await runner.cleanup()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=200, help='ワークロードごとのメッセージ数')
+    parser.add_argument('--rate', type=float, default=0, help='1秒あたりに流すメッセージ数（0なら一度に流す）')
+    parser.add_argument('--workloads', nargs='+', choices=WORKLOADS, default=list(WORKLOADS))
+    parser.add_argument('--attachment-size', type=int, default=256 * 1024, help='添付ファイル1件のバイト数（1メッセージに3件）')
+    parser.add_argument('--latency', type=float, default=0.05, help='代用サーバーの応答までの秒数')
+    parser.add_argument('--jitter', type=float, default=0.02, help='応答時間に加えるランダムな秒数の上限')
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help='代用サーバーが429を返す割合（0〜1）')
+    parser.add_argument('--retry-after', type=float, default=0.2, help='429の Retry-After 秒数')
+    parser.add_argument('--upload-bandwidth', type=float, default=0.0, help='アップロードの帯域（バイト/秒、0で無制限）')
+    parser.add_argument('--timeout', type=float, default=300, help='ワークロードごとの待ち時間の上限（秒）')
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
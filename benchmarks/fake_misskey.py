@@ -0,0 +1,143 @@
+"""ベンチマーク用のMisskey・Discord CDN・YouTube Data APIの代用サーバー
+
+    python benchmarks/fake_misskey.py [--port 3000] [--latency 0.05] [--rate-limit-ratio 0.05]
+
+MISSKEY_HOST=http://127.0.0.1:3000 を指定すれば、実際のBotをつないで試すこともできる。
+以下のエンドポイントを提供する（応答は常に成功。--rate-limit-ratio の割合で429を返す）。
+
+    POST /api/notes/create, /api/notes/update, /api/notes/delete
+    POST /api/drive/files/create, /api/drive/files/show, /api/drive/files/find-by-hash
+    GET  /cdn/{name}?size=N          Discord CDNの代わり（Nバイトの画像風データ）
+    GET  /youtube/v3/videos?id=...   YouTube Data API videos.list の代わり
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import random
+
+from aiohttp import web
+
+PNG_HEADER = b'\x89PNG\r\n\x1a\n'
+
+class FakeMisskey:
+    """遅延と429を注入できるMisskey APIの代用"""
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0, rate_limit_ratio: float = 0.0,
+                 retry_after: float = 0.2, upload_bandwidth: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.upload_bandwidth = upload_bandwidth  # バイト/秒（0なら帯域の制限なし）
+        self.ids = itertools.count(1)
+        self.files: dict[str, str] = {}  # MD5 -> ファイルID
+        self.stats = {'notes': 0, 'uploads': 0, 'upload_bytes': 0, 'rate_limited': 0}
+    
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_post('/api/notes/create', self.notes_create)
+        app.router.add_post('/api/notes/update', self.ok)
+        app.router.add_post('/api/notes/delete', self.ok)
+        app.router.add_post('/api/drive/files/create', self.drive_create)
+        app.router.add_post('/api/drive/files/show', self.ok)
+        app.router.add_post('/api/drive/files/find-by-hash', self.find_by_hash)
+        app.router.add_get('/cdn/{name}', self.cdn)
+        app.router.add_get('/youtube/v3/videos', self.youtube_videos)
+        return app
+    
+    async def delay(self, size: int = 0):
+        """API処理時間（と転送時間）の分だけ待つ"""
+        seconds = self.latency + random.uniform(0, self.jitter)
+        if self.upload_bandwidth and size:
+            seconds += size / self.upload_bandwidth
+        await asyncio.sleep(seconds)
+    
+    def rate_limited(self) -> web.Response | None:
+        """指定の割合でレート制限の応答を返す"""
+        if self.rate_limit_ratio and random.random() < self.rate_limit_ratio:
+            self.stats['rate_limited'] += 1
+            return web.json_response(
+                {'error': {'code': 'RATE_LIMIT_EXCEEDED', 'message': 'Rate limit exceeded. Please try again later.'}},
+                status=429, headers={'Retry-After': str(self.retry_after)},
+            )
+        return None
+    
+    async def notes_create(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        if (limited := self.rate_limited()) is not None:
+            return limited
+        await self.delay()
+        self.stats['notes'] += 1
+        note_id = f"note{next(self.ids)}"
+        return web.json_response({'createdNote': {'id': note_id, 'text': body.get('text'), 'fileIds': body.get('mediaIds', [])}})
+    
+    async def drive_create(self, request: web.Request) -> web.Response:
+        # ストリーミング転送も含めて、ボディは最後まで読み切る
+        reader = await request.multipart()
+        digest = hashlib.md5()
+        size = 0
+        async for part in reader:
+            if part.name != 'file':
+                await part.read()
+                continue
+            while chunk := await part.read_chunk(64 * 1024):
+                digest.update(chunk)
+                size += len(chunk)
+        if (limited := self.rate_limited()) is not None:
+            return limited
+        await self.delay(size)
+        self.stats['uploads'] += 1
+        self.stats['upload_bytes'] += size
+        file_id = f"file{next(self.ids)}"
+        self.files[digest.hexdigest()] = file_id
+        return web.json_response({'id': file_id, 'md5': digest.hexdigest(), 'size': size})
+    
+    async def find_by_hash(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        file_id = self.files.get(body.get('md5'))
+        return web.json_response([{'id': file_id}] if file_id else [])
+    
+    async def ok(self, request: web.Request) -> web.Response:
+        await request.read()
+        await self.delay()
+        return web.json_response({})
+    
+    async def cdn(self, request: web.Request) -> web.Response:
+        # 名前ごとに内容を変え、重複排除が効かないようにする
+        size = int(request.query.get('size', 100_000))
+        seed = hashlib.md5(request.match_info['name'].encode()).digest()
+        body = PNG_HEADER + (seed * (size // len(seed) + 1))[:max(0, size - len(PNG_HEADER))]
+        return web.Response(body=body, content_type='image/png')
+    
+    async def youtube_videos(self, request: web.Request) -> web.Response:
+        await self.delay()
+        items = [
+            {'id': video_id, 'snippet': {'title': f"動画 {video_id}", 'channelTitle': 'ベンチマーク', 'thumbnails': {}}}
+            for video_id in request.query.get('id', '').split(',') if video_id
+        ]
+        return web.json_response({'items': items})
+
+async def start_fake_server(fake: FakeMisskey, host: str = '127.0.0.1', port: int = 0) -> tuple[web.AppRunner, str]:
+    """代用サーバーを起動し、(runner, ベースURL) を返す（port=0なら空きポート）"""
+    runner = web.AppRunner(fake.make_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    bound_port = runner.addresses[0][1]
+    return runner, f"http://{host}:{bound_port}"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3000)
+    parser.add_argument('--latency', type=float, default=0.05, help='APIの応答までの秒数')
+    parser.add_argument('--jitter', type=float, default=0.0, help='応答時間に加えるランダムな秒数の上限')
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help='429を返す割合（0〜1）')
+    parser.add_argument('--retry-after', type=float, default=0.2, help='429の Retry-After 秒数')
+    parser.add_argument('--upload-bandwidth', type=float, default=0.0, help='アップロードの帯域（バイト/秒、0で無制限）')
+    args = parser.parse_args()
+    
+    fake = FakeMisskey(args.latency, args.jitter, args.rate_limit_ratio, args.retry_after, args.upload_bandwidth)
+    web.run_app(fake.make_app(), host=args.host, port=args.port, access_log=None)
+
+if __name__ == '__main__':
+    main()
@@ -1,81 +1,624 @@
+from __future__ import annotations
+
+import time
+STARTUP_STARTED = time.perf_counter()  # 起動時間の内訳の計測開始（インポートも含める）
+
 import discord
-import requests
 import os
 import aiohttp
 import asyncio
 import re
-from urllib.parse import urlparse, parse_qs
+import random
+import hashlib
+import html
+import importlib.util
+import sqlite3
 import json
+import sys
+import queue
+import atexit
+import contextlib
+import logging
+import logging.handlers
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Mapping
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from types import MappingProxyType
+from typing import TYPE_CHECKING
+from urllib.parse import urlsplit
+
+# 使う場合だけ読み込むモジュール（メトリクスサーバー・画像変換のプロセスプール）
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+    from aiohttp import web
+
+# 起動時間の内訳（各段階にかかった秒数）。最初の on_ready でまとめてログに出す
+startup_timings: dict[str, float] = {}
+startup_last_mark = STARTUP_STARTED
+
+def mark_startup(stage: str):
+    """起動の段階が終わった時刻を記録"""
+    global startup_last_mark
+    now = time.perf_counter()
+    startup_timings[stage] = round(now - startup_last_mark, 3)
+    startup_last_mark = now
+
+mark_startup('imports')
+
+logger = logging.getLogger('discord_to_misskey')
+
+# ログ設定（LOG_FORMAT=json なら1行1JSON、text なら人が読みやすい形式）
+LOG_LEVEL  = (os.getenv('LOG_LEVEL') or 'INFO').upper()
+LOG_FORMAT = (os.getenv('LOG_FORMAT') or 'json').lower()
+
+# LogRecordの標準属性（これ以外は extra で渡された構造化フィールドとして出力する）
+LOG_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+class JSONFormatter(logging.Formatter):
+    """ログを1行1JSON（JSON Lines）で出力するフォーマッター"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in LOG_RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """ログをキューに積むだけのハンドラー（出力は別スレッドのQueueListenerが行う）"""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 整形済みメッセージと例外テキストだけを確定させ、extraのフィールドは残したまま渡す
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+log_listener: logging.handlers.QueueListener | None = None
 
-# 環境変数から設定を読み込み
-def get_env_var(var_name, required=True):
-    value = os.getenv(var_name)
-    if required and not value:
-        print(f"⚠️  環境変数 {var_name} が設定されていません")
-    return value
+def setup_logging():
+    """ロガーを設定（標準出力への書き込みはイベントループと別スレッドで行う）"""
+    global log_listener
+    handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-7s %(name)s: %(message)s'))
+    log_queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue, handler)
+    root = logging.getLogger()
+    root.handlers[:] = [LogQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+    # discord.py のDEBUGログはゲートウェイのイベントごとに出るため、INFO以上に抑える
+    logging.getLogger('discord').setLevel(max(logging.getLevelName(LOG_LEVEL), logging.INFO))
+    log_listener.start()
+    atexit.register(shutdown_logging)
+
+def shutdown_logging():
+    """キューに残ったログを書き出してから停止"""
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+# スクリプトとして起動した場合は、設定の読み込み時の警告も含めて最初から構造化ログにする
+if __name__ == "__main__":
+    setup_logging()
+
+# ===== 設定（環境変数は起動時に1回だけ読み込み、以降は変更しない） =====
+
+@dataclass(frozen=True)
+class Destination:
+    """投稿先（Misskeyインスタンス・アカウント）の設定"""
+    name: str
+    host: str | None
+    token: str | None
+    rate_limit: float
+    burst: int
+
+@dataclass(frozen=True)
+class Config:
+    """Botの設定（load_config で環境変数から作成）"""
+    discord_bot_token: str | None
+    target_channel_ids: frozenset[int]            # イベントごとに判定するので集合で持つ
+    my_user_ids: frozenset[int]                   # ★ 自分のDiscordユーザーID（数値）だけ通す（カンマ区切りで複数可）
+    destinations: tuple[Destination, ...]
+    channel_routes: Mapping[int, tuple[str, ...]]  # チャンネルID -> 投稿先名（未指定のチャンネルは全投稿先）
+    youtube_api_key: str | None
+    # HTTPクライアント設定（コネクションプール・タイムアウト）
+    http_pool_limit: int                          # 全体の同時接続数上限
+    http_pool_limit_per_host: int                 # ホストごとの同時接続数上限
+    http_keepalive_timeout: float                 # アイドル接続の保持秒数
+    http_connect_timeout: float                   # 接続確立のタイムアウト秒数
+    http_total_timeout: float                     # 1リクエスト全体のタイムアウト秒数
+    # 添付ファイルの同時アップロード数（投稿先ごと）と、メモリに載せずストリーミング転送するサイズ
+    upload_concurrency: int
+    stream_upload_threshold: int
+    stream_chunk_size: int
+    # Misskey APIのレート制限・再試行設定
+    misskey_rate_limit: float                     # 1秒あたりのリクエスト数（トークン補充速度）
+    misskey_rate_burst: int                       # バーストで許容するリクエスト数
+    misskey_max_retries: int
+    misskey_retry_base_delay: float               # バックオフの初期値（秒）
+    misskey_retry_max_delay: float                # バックオフの上限（秒）
+    # YouTube動画情報・サムネイルのキャッシュ設定
+    youtube_cache_size: int
+    youtube_cache_ttl: float
+    thumbnail_cache_size: int                     # サムネイルは1枚数百KBあるので少なめに
+    thumbnail_cache_ttl: float
+    cache_persist: bool                           # SQLiteにも保存して再起動後も利用
+    # YouTube Data APIの一括取得設定（videos.listは1回で最大50件まで指定可能）
+    youtube_batch_size: int
+    youtube_batch_window: float                   # 他のメッセージの要求を待ってまとめる秒数
+    # リンクプレビュー（対応するリンクの情報を取得してカードを付ける）
+    link_preview_providers: tuple[str, ...]       # 使うプロバイダー（先に書いたものが優先してリンクを処理）
+    link_preview_deadline: float                  # 情報の取得を待つ秒数（間に合わなければ情報なしで投稿）
+    link_preview_timeout: float                   # OGP取得の1リクエストのタイムアウト秒数
+    link_preview_max_links: int                   # 1メッセージでOGPを取得するリンク数の上限
+    link_preview_cache_size: int
+    link_preview_cache_ttl: float
+    # Driveアップロードの重複排除（同じ内容のファイルは既存のDriveファイルIDを再利用）
+    drive_dedup: bool
+    drive_dedup_remote: bool                      # Misskeyの drive/files/find-by-hash でも確認
+    # アップロード前の画像変換（Pillowが必要。縮小・再エンコード・メタデータ除去をプロセスプールで実行）
+    media_transcode: bool
+    media_max_dimension: int                      # 長辺の最大ピクセル数
+    media_format: str                             # webp / jpeg
+    media_quality: int
+    media_workers: int
+    # シャーディング（0なら使わない）。SHARD_IDS を指定すると、このプロセスはそのシャードだけを担当
+    shard_count: int
+    shard_ids: tuple[int, ...]
+    shard_processes: int                          # `shards` コマンドでシャードを分けるプロセス数
+    # メトリクス・ヘルスチェック用HTTPサーバー（fly.tomlの internal_port と合わせる。0で無効）
+    metrics_host: str
+    metrics_port: int
+    # 永続ジョブキュー（SQLite）とワーカー設定
+    bot_db_path: str
+    queue_workers: int
+    queue_max_attempts: int
+    queue_retry_base_delay: float                 # 再試行間隔の初期値（秒、指数的に増加）
+    queue_lease_timeout: float                    # 処理中のまま放置されたジョブを再取得するまでの秒数
+    queue_poll_interval: float
+    queue_shutdown_timeout: float                 # 終了時に処理中ジョブの完了を待つ秒数
+    # 停止中に投稿されたメッセージの取り込み（バックフィル）
+    backfill_on_start: bool                       # 常駐時も起動直後に取り込む
+    backfill_max_age_days: float                  # これより古いメッセージは取り込まない（0で無制限）
+    backfill_concurrency: int                     # 同時に遡るチャンネル数
+    backfill_rate: float                          # 1秒あたりにキューへ積むメッセージ数
+    backfill_max_pending: int                     # 未完了のジョブがこれ以上あれば積むのを待つ
+    # Discordのメッセージの編集・削除をMisskeyのノートに反映
+    sync_edits: bool
+    note_edit_endpoint: str                       # 空ならノートを作り直して反映
+    note_map_retention_days: float                # これより古い投稿の編集・削除は反映しない
+    # 連続投稿をまとめて1つのノートにする（0で無効）・長文を返信のチェーンに分割して投稿
+    coalesce_window: float                        # 前のメッセージからこの秒数以内なら同じノートにまとめる
+    coalesce_windows: Mapping[int, float]         # チャンネルごとの上書き（チャンネルID -> 秒数）
+    coalesce_max_messages: int                    # 1つのノートにまとめるメッセージ数の上限
+    split_long_notes: bool                        # 上限を超える本文を切り詰めずに返信として続ける
+    # 設定の誤り・不足（validate_environment で報告する）
+    missing: tuple[str, ...] = ()
+    problems: tuple[str, ...] = ()
+
+def load_config(env: Mapping[str, str] = os.environ) -> Config:
+    """環境変数から設定を作成（読み込みは1回だけ。誤りは例外にせず missing / problems に記録）"""
+    missing = []
+    problems = []
+    
+    def get(name: str, default: str | None = None, required: bool = False) -> str | None:
+        value = env.get(name) or default
+        if required and not value:
+            missing.append(name)
+        return value
+    
+    def number(convert, name: str, default):
+        try:
+            return convert(get(name) or default)
+        except ValueError:
+            problems.append(f"{name} が数値ではありません: {get(name)}")
+            return convert(default)
+    
+    def flag(name: str, default: bool) -> bool:
+        return (get(name) or ('1' if default else '0')) == '1'
+    
+    rate_limit = number(float, 'MISSKEY_RATE_LIMIT', 2)
+    burst = number(int, 'MISSKEY_RATE_BURST', 10)
+    
+    # 複数の投稿先（Misskeyインスタンス・アカウント）を使う場合はJSONで指定
+    # 例: [{"name": "main", "host": "https://misskey.io", "token_env": "MAIN_TOKEN"}, {"name": "sub", "host": "https://example.com", "token": "...", "rate_limit": 1}]
+    destinations = []
+    destinations_json = get('MISSKEY_DESTINATIONS')
+    if not destinations_json:
+        # 単一の投稿先の名前はホストにしておく（既存の重複排除インデックスをそのまま使えるように）
+        host = get('MISSKEY_HOST', required=True)
+        destinations.append(Destination(host, host, get('MISSKEY_TOKEN', required=True), rate_limit, burst))
+    else:
+        try:
+            for entry in json.loads(destinations_json):
+                token = entry.get('token') or (env.get(entry['token_env']) if entry.get('token_env') else None)
+                destinations.append(Destination(
+                    entry.get('name') or entry['host'], entry['host'], token,
+                    float(entry.get('rate_limit', rate_limit)), int(entry.get('burst', burst)),
+                ))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            problems.append(f"MISSKEY_DESTINATIONS が正しくありません: {e}")
+        if not destinations:
+            problems.append("MISSKEY_DESTINATIONS に投稿先がありません")
+        if len({dest.name for dest in destinations}) != len(destinations):
+            problems.append("MISSKEY_DESTINATIONS の name が重複しています")
+        for dest in destinations:
+            if not dest.host or not dest.token:
+                problems.append(f"投稿先 {dest.name} の host または token が未設定です")
+    for dest in destinations:
+        # トークンの補充速度で割って待ち時間を求めるため、0以下は受け付けない
+        if dest.rate_limit <= 0 or dest.burst < 1:
+            problems.append(f"投稿先 {dest.name} の rate_limit は0より大きく、burst は1以上にしてください")
+    
+    # チャンネルごとの投稿先（未指定のチャンネルは全ての投稿先へ）例: {"863820588148981790": ["main", "sub"]}
+    channel_routes = {}
+    try:
+        channel_routes = {
+            int(channel_id): tuple(names)
+            for channel_id, names in json.loads(get('CHANNEL_ROUTES') or '{}').items()
+        }
+    except (ValueError, TypeError, AttributeError) as e:
+        problems.append(f"CHANNEL_ROUTES が正しくありません: {e}")
+    names = {dest.name for dest in destinations}
+    for channel_id, route in channel_routes.items():
+        unknown = [name for name in route if name not in names]
+        if unknown:
+            problems.append(f"CHANNEL_ROUTES のチャンネル {channel_id} に未定義の投稿先があります: {', '.join(unknown)}")
+    
+    # チャンネルごとのまとめる秒数（未指定のチャンネルは COALESCE_WINDOW）例: {"863820588148981790": 30}
+    coalesce_windows = {}
+    try:
+        coalesce_windows = {
+            int(channel_id): float(window)
+            for channel_id, window in json.loads(get('COALESCE_WINDOWS') or '{}').items()
+        }
+    except (ValueError, TypeError, AttributeError) as e:
+        problems.append(f"COALESCE_WINDOWS が正しくありません: {e}")
+    
+    def id_list(name: str, required: bool = False) -> list[int]:
+        try:
+            return [int(x.strip()) for x in (get(name, required=required) or '').split(',') if x.strip()]
+        except ValueError:
+            problems.append(f"{name}が正しく設定されていません")
+            return []
+    
+    # チャンネルID・ユーザーIDは集合にして、イベントごとの判定を件数によらず一定時間にする
+    target_channel_ids = frozenset(id_list('TARGET_CHANNEL_IDS', required=True))
+    my_user_ids = frozenset(id_list('MY_USER_ID', required=True))
+    
+    shard_count = number(int, 'SHARD_COUNT', 0)
+    shard_ids = tuple(id_list('SHARD_IDS'))
+    if shard_ids and not shard_count:
+        problems.append("SHARD_IDS を指定する場合は SHARD_COUNT も指定してください")
+    elif any(not 0 <= shard_id < shard_count for shard_id in shard_ids):
+        problems.append(f"SHARD_IDS は0〜{shard_count - 1}の範囲で指定してください")
+    
+    return Config(
+        discord_bot_token=get('DISCORD_BOT_TOKEN', required=True),
+        target_channel_ids=target_channel_ids,
+        my_user_ids=my_user_ids,
+        destinations=tuple(destinations),
+        channel_routes=MappingProxyType(channel_routes),
+        youtube_api_key=get('YOUTUBE_API_KEY'),
+        http_pool_limit=number(int, 'HTTP_POOL_LIMIT', 100),
+        http_pool_limit_per_host=number(int, 'HTTP_POOL_LIMIT_PER_HOST', 10),
+        http_keepalive_timeout=number(float, 'HTTP_KEEPALIVE_TIMEOUT', 60),
+        http_connect_timeout=number(float, 'HTTP_CONNECT_TIMEOUT', 10),
+        http_total_timeout=number(float, 'HTTP_TOTAL_TIMEOUT', 120),
+        upload_concurrency=number(int, 'UPLOAD_CONCURRENCY', 4),
+        stream_upload_threshold=number(int, 'STREAM_UPLOAD_THRESHOLD', 8 * 1024 * 1024),
+        stream_chunk_size=number(int, 'STREAM_CHUNK_SIZE', 64 * 1024),
+        misskey_rate_limit=rate_limit,
+        misskey_rate_burst=burst,
+        misskey_max_retries=number(int, 'MISSKEY_MAX_RETRIES', 5),
+        misskey_retry_base_delay=number(float, 'MISSKEY_RETRY_BASE_DELAY', 1),
+        misskey_retry_max_delay=number(float, 'MISSKEY_RETRY_MAX_DELAY', 60),
+        youtube_cache_size=number(int, 'YOUTUBE_CACHE_SIZE', 512),
+        youtube_cache_ttl=number(float, 'YOUTUBE_CACHE_TTL', 6 * 3600),
+        thumbnail_cache_size=number(int, 'THUMBNAIL_CACHE_SIZE', 32),
+        thumbnail_cache_ttl=number(float, 'THUMBNAIL_CACHE_TTL', 24 * 3600),
+        cache_persist=flag('CACHE_PERSIST', False),
+        youtube_batch_size=min(number(int, 'YOUTUBE_BATCH_SIZE', 50), 50),
+        youtube_batch_window=number(float, 'YOUTUBE_BATCH_WINDOW', 0.05),
+        # 空で指定した場合はリンクプレビューを使わない
+        link_preview_providers=tuple(
+            name.strip().lower() for name in env.get('LINK_PREVIEW_PROVIDERS', 'youtube').split(',') if name.strip()
+        ),
+        link_preview_deadline=number(float, 'LINK_PREVIEW_DEADLINE', 3),
+        link_preview_timeout=number(float, 'LINK_PREVIEW_TIMEOUT', 10),
+        link_preview_max_links=number(int, 'LINK_PREVIEW_MAX_LINKS', 3),
+        link_preview_cache_size=number(int, 'LINK_PREVIEW_CACHE_SIZE', 256),
+        link_preview_cache_ttl=number(float, 'LINK_PREVIEW_CACHE_TTL', 6 * 3600),
+        drive_dedup=flag('DRIVE_DEDUP', True),
+        drive_dedup_remote=flag('DRIVE_DEDUP_REMOTE', False),
+        media_transcode=flag('MEDIA_TRANSCODE', False),
+        media_max_dimension=number(int, 'MEDIA_MAX_DIMENSION', 2048),
+        media_format=get('MEDIA_FORMAT', 'webp').lower(),
+        media_quality=number(int, 'MEDIA_QUALITY', 85),
+        media_workers=number(int, 'MEDIA_WORKERS', 1),
+        shard_count=shard_count,
+        shard_ids=shard_ids,
+        shard_processes=number(int, 'SHARD_PROCESSES', 1),
+        metrics_host=get('METRICS_HOST', '0.0.0.0'),
+        metrics_port=number(int, 'METRICS_PORT', 8080),
+        bot_db_path=get('BOT_DB_PATH', 'bot_state.db'),
+        queue_workers=number(int, 'QUEUE_WORKERS', 2),
+        queue_max_attempts=number(int, 'QUEUE_MAX_ATTEMPTS', 10),
+        queue_retry_base_delay=number(float, 'QUEUE_RETRY_BASE_DELAY', 5),
+        queue_lease_timeout=number(float, 'QUEUE_LEASE_TIMEOUT', 600),
+        queue_poll_interval=number(float, 'QUEUE_POLL_INTERVAL', 1),
+        queue_shutdown_timeout=number(float, 'QUEUE_SHUTDOWN_TIMEOUT', 20),
+        backfill_on_start=flag('BACKFILL', False),
+        backfill_max_age_days=number(float, 'BACKFILL_MAX_AGE_DAYS', 7),
+        backfill_concurrency=number(int, 'BACKFILL_CONCURRENCY', 2),
+        backfill_rate=number(float, 'BACKFILL_RATE', 2),
+        backfill_max_pending=number(int, 'BACKFILL_MAX_PENDING', 20),
+        sync_edits=flag('SYNC_EDITS', True),
+        note_edit_endpoint=env.get('NOTE_EDIT_ENDPOINT', 'notes/update'),
+        note_map_retention_days=number(float, 'NOTE_MAP_RETENTION_DAYS', 90),
+        coalesce_window=number(float, 'COALESCE_WINDOW', 0),
+        coalesce_windows=MappingProxyType(coalesce_windows),
+        coalesce_max_messages=max(1, number(int, 'COALESCE_MAX_MESSAGES', 10)),
+        split_long_notes=flag('SPLIT_LONG_NOTES', False),
+        missing=tuple(missing),
+        problems=tuple(problems),
+    )
 
-DISCORD_BOT_TOKEN = get_env_var('DISCORD_BOT_TOKEN')
-MISSKEY_TOKEN     = get_env_var('MISSKEY_TOKEN')
-MISSKEY_HOST      = get_env_var('MISSKEY_HOST')
+config = load_config()
+mark_startup('config')
 
-# 複数のチャンネルIDをリストに
-TARGET_CHANNEL_IDS_STR = get_env_var('TARGET_CHANNEL_IDS')
-TARGET_CHANNEL_IDS = [int(x.strip()) for x in TARGET_CHANNEL_IDS_STR.split(',')] if TARGET_CHANNEL_IDS_STR else []
+# YouTube Data API videos.list のURL（ベンチマークでは代用サーバーに差し替える）
+YOUTUBE_API_URL = 'https://www.googleapis.com/youtube/v3/videos'
 
-# ★ 自分のDiscordユーザーID（数値）だけ通す
-MY_USER_ID = int(get_env_var('MY_USER_ID')) if get_env_var('MY_USER_ID') else None
+# `python discord_to_misskey.py backfill` で取り込みと投稿だけを行って終了
+BACKFILL_ONLY = False
 
 intents = discord.Intents.default()
 intents.message_content = True
-client = discord.Client(intents=intents)
+if config.shard_count:
+    # シャードごとにゲートウェイ接続を分ける（SHARD_IDS を指定しなければ全シャードをこのプロセスで担当）
+    client = discord.AutoShardedClient(intents=intents, shard_count=config.shard_count, shard_ids=list(config.shard_ids) or None)
+else:
+    client = discord.Client(intents=intents)
 
 # 環境変数の検証
 def validate_environment():
-    print("🔍 環境変数の検証を開始...")
-    
-    # すべての環境変数を確認
-    all_env_vars = os.environ
-    print(f"📋 利用可能な環境変数: {list(all_env_vars.keys())}")
+    logger.info("🔍 環境変数の検証を開始...")
     
+    # 読み込み済みの設定を確認するだけで、環境変数は読み直さない
     required_vars = {
-        'DISCORD_BOT_TOKEN': DISCORD_BOT_TOKEN,
-        'MISSKEY_TOKEN': MISSKEY_TOKEN,
-        'MISSKEY_HOST': MISSKEY_HOST,
-        'TARGET_CHANNEL_IDS': TARGET_CHANNEL_IDS_STR,
-        'MY_USER_ID': os.getenv('MY_USER_ID')
+        'DISCORD_BOT_TOKEN': config.discord_bot_token,
+        'TARGET_CHANNEL_IDS': ','.join(map(str, sorted(config.target_channel_ids))),
+        'MY_USER_ID': ','.join(map(str, sorted(config.my_user_ids))),
     }
-    
-    print("🔍 必要な環境変数の値:")
     for var, value in required_vars.items():
         if value:
-            print(f"  ✅ {var}: {'*' * len(str(value)) if 'TOKEN' in var else value}")
-        else:
-            print(f"  ❌ {var}: 未設定")
+            logger.info("✅ %s: %s", var, '*' * len(str(value)) if 'TOKEN' in var else value)
+    for var in config.missing:
+        logger.error("❌ %s: 未設定", var)
     
-    missing_vars = [var for var, value in required_vars.items() if not value]
+    if config.missing:
+        logger.error("❌ 必要な環境変数が設定されていません: %s（環境変数を設定してから再実行してください）", ', '.join(config.missing))
+        exit(1)
     
-    if missing_vars:
-        print(f"❌ 必要な環境変数が設定されていません: {', '.join(missing_vars)}")
-        print("環境変数を設定してから再実行してください。")
+    for problem in config.problems:
+        logger.error("❌ %s", problem)
+    if config.problems:
         exit(1)
     
-    if not TARGET_CHANNEL_IDS:
-        print("❌ TARGET_CHANNEL_IDSが正しく設定されていません")
+    if not config.target_channel_ids:
+        logger.error("❌ TARGET_CHANNEL_IDSが正しく設定されていません")
         exit(1)
     
-    if not MY_USER_ID:
-        print("❌ MY_USER_IDが正しく設定されていません")
+    if not config.my_user_ids:
+        logger.error("❌ MY_USER_IDが正しく設定されていません")
         exit(1)
     
-    print("✅ 環境変数の検証が完了しました")
-    print(f"📺 監視チャンネル数: {len(TARGET_CHANNEL_IDS)}")
-    print(f"👤 対象ユーザーID: {MY_USER_ID}")
+    if config.shard_count:
+        logger.info("✅ シャード: %s / %d", ', '.join(map(str, config.shard_ids)) or '全て', config.shard_count)
+    
+    logger.info("✅ 投稿先: %s", ', '.join(f"{dest.name} ({dest.host})" for dest in config.destinations))
+    
+    if config.media_transcode and not media_transcode_available():
+        logger.warning("⚠️ MEDIA_TRANSCODE=1 ですがPillowがインストールされていないため、画像変換は行いません")
+    
+    logger.info("✅ 環境変数の検証が完了しました（監視チャンネル数: %d, 対象ユーザーID: %s）",
+                len(config.target_channel_ids), ', '.join(map(str, sorted(config.my_user_ids))))
+
+# 共有HTTPセッション（起動時に作成し、終了時にクローズ）
+http_session: aiohttp.ClientSession | None = None
+
+def create_http_session() -> aiohttp.ClientSession:
+    """コネクションプール・タイムアウト設定済みのHTTPセッションを作成"""
+    connector = aiohttp.TCPConnector(
+        limit=config.http_pool_limit,
+        limit_per_host=config.http_pool_limit_per_host,
+        keepalive_timeout=config.http_keepalive_timeout,
+        ttl_dns_cache=300,  # DNS解決結果を5分間キャッシュ
+    )
+    timeout = aiohttp.ClientTimeout(total=config.http_total_timeout, connect=config.http_connect_timeout)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+async def get_http_session() -> aiohttp.ClientSession:
+    """プール済みの共有HTTPセッションを取得（未作成なら作成）"""
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = create_http_session()
+        logger.info("🌐 共有HTTPセッションを作成しました (limit=%d, per_host=%d)", config.http_pool_limit, config.http_pool_limit_per_host)
+    return http_session
+
+async def close_http_session():
+    """共有HTTPセッションをクローズ"""
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+        logger.info("🌐 共有HTTPセッションをクローズしました")
+    http_session = None
+
+class TTLCache:
+    """有効期限付きLRUキャッシュ（persist=Trueなら状態DBにも保存して再起動後も利用）"""
+    def __init__(self, name: str, maxsize: int, ttl: float, persist: bool = False,
+                 dumps=lambda value: value, loads=lambda value: value):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.persist = persist
+        self.dumps = dumps
+        self.loads = loads
+        self.entries: OrderedDict = OrderedDict()  # key -> (expires_at, value)
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+    
+    def get(self, key: str):
+        """値を取得（期限切れ・未登録ならNone）"""
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[1]
+            del self.entries[key]
+        
+        if self.persist:
+            row = get_db().execute(
+                "SELECT value, expires_at FROM cache_entries WHERE namespace = ? AND key = ?",
+                (self.name, key)
+            ).fetchone()
+            if row is not None and row[1] > now:
+                value = self.loads(row[0])
+                self._store(key, value, row[1])
+                self.stats['disk_hits'] += 1
+                return value
+        
+        self.stats['misses'] += 1
+        return None
+    
+    def set(self, key: str, value):
+        """値を登録（上限を超えたら最も古く使われたものから削除）"""
+        expires_at = time.time() + self.ttl
+        self._store(key, value, expires_at)
+        if self.persist:
+            get_db().execute(
+                "INSERT OR REPLACE INTO cache_entries (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (self.name, key, self.dumps(value), expires_at)
+            )
+    
+    def _store(self, key: str, value, expires_at: float):
+        self.entries[key] = (expires_at, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+youtube_info_cache = TTLCache(
+    'youtube_info', config.youtube_cache_size, config.youtube_cache_ttl, persist=config.cache_persist,
+    dumps=lambda value: json.dumps(value, ensure_ascii=False), loads=json.loads
+)
+youtube_thumbnail_cache = TTLCache('youtube_thumbnail', config.thumbnail_cache_size, config.thumbnail_cache_ttl, persist=config.cache_persist)
+link_preview_cache = TTLCache(
+    'link_preview', config.link_preview_cache_size, config.link_preview_cache_ttl, persist=config.cache_persist,
+    dumps=lambda value: json.dumps(value, ensure_ascii=False), loads=json.loads
+)
+
+# ===== メトリクス =====
+# Prometheusのテキスト形式で /metrics から公開する
+
+def escape_label(value) -> str:
+    """Prometheusのラベル値をエスケープ（\\ と " と改行）"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Histogram:
+    """ラベル付きのレイテンシヒストグラム（Prometheus形式）"""
+    def __init__(self, name: str, help_text: str, label: str,
+                 buckets: tuple = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self.series: dict[str, list] = {}  # ラベル値 -> [バケットごとの件数..., 合計, 件数]
+    
+    def observe(self, label_value: str, value: float):
+        series = self.series.setdefault(label_value, [0] * (len(self.buckets) + 2))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+    
+    @contextlib.contextmanager
+    def time(self, label_value: str):
+        """with ブロックの所要時間を記録"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(label_value, time.perf_counter() - started)
+    
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_value, series in sorted(self.series.items()):
+            labels = f'{self.label}="{escape_label(label_value)}"'
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series[-1]}')
+            lines.append(f'{self.name}_sum{{{labels}}} {series[-2]:.6f}')
+            lines.append(f'{self.name}_count{{{labels}}} {series[-1]}')
+        return lines
+
+def render_counter(name: str, help_text: str, label: str, values: dict, metric_type: str = 'counter') -> list[str]:
+    """ラベル付きカウンター（またはゲージ）をPrometheus形式で出力"""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for label_value, value in sorted(values.items()):
+        lines.append(f'{name}{{{label}="{escape_label(label_value)}"}} {value}')
+    return lines
+
+# 処理段階ごとのレイテンシ（discord_fetch / transcode / drive_upload / youtube_lookup / link_preview / notes_create / job）
+# link_preview は締め切りまでの待ち時間、youtube_lookup は videos.list 1回の実際の所要時間
+stage_latency = Histogram('crosspost_stage_duration_seconds', '処理段階ごとの所要時間', 'stage')
+# メッセージ単位の結果（posted / skipped / failed など。coalesced は前のノートにまとめたメッセージ）
+message_counts = {'posted': 0, 'coalesced': 0, 'edited': 0, 'deleted': 0, 'skipped': 0, 'failed': 0}
+last_post_at: float | None = None
 
 MAX_TEXT = 1000  # Misskeyのノート上限を大幅短縮（折りたたみ完全防止）
 
+MAX_NOTE_FILES = 16  # 1つのノートに添付できるファイル数
+SPLIT_SEPARATORS = ('\n\n', '\n', '。', '. ', '、', ' ')  # 長文を分割する位置（優先順）
+
 def truncate_for_misskey(text: str) -> str:
     return text if len(text) <= MAX_TEXT else (text[:MAX_TEXT-3] + '...')
 
+def split_for_misskey(text: str) -> list[str]:
+    """上限を超える本文を、段落・行・文の区切りでノート1つ分ずつに分割"""
+    chunks = []
+    while len(text) > MAX_TEXT:
+        head = text[:MAX_TEXT]
+        for separator in SPLIT_SEPARATORS:
+            # 区切りが前の方にしかなければ、次の区切りを試す（短すぎるノートを作らない）
+            cut = head.rfind(separator)
+            if cut >= MAX_TEXT // 2:
+                cut += len(separator)
+                break
+        else:
+            cut = MAX_TEXT
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text or not chunks:
+        chunks.append(text)
+    return chunks
+
 def get_youtube_thumbnail_urls(video_id: str) -> dict:
     """YouTubeの高解像度サムネイルURLを生成"""
     base_url = f"https://img.youtube.com/vi/{video_id}"
@@ -89,182 +632,179 @@ def get_youtube_thumbnail_urls(video_id: str) -> dict:
 
 async def download_youtube_thumbnail(video_id: str, quality: str = 'maxres') -> bytes:
     """YouTubeのサムネイル画像をダウンロード"""
+    cache_key = f"{video_id}:{quality}"
+    cached = youtube_thumbnail_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
     try:
         urls = get_youtube_thumbnail_urls(video_id)
         url = urls.get(quality, urls['maxres'])
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    return await response.read()
-                else:
-                    # 最高解像度が利用できない場合は標準解像度を試す
-                    if quality == 'maxres':
-                        return await download_youtube_thumbnail(video_id, 'medium')  # sd → mediumに変更
-                    return None
+        session = await get_http_session()
+        async with session.get(url) as response:
+            if response.status == 200:
+                thumbnail = await response.read()
+                youtube_thumbnail_cache.set(cache_key, thumbnail)
+                return thumbnail
+            else:
+                # 最高解像度が利用できない場合は標準解像度を試す
+                if quality == 'maxres':
+                    return await download_youtube_thumbnail(video_id, 'medium')  # sd → mediumに変更
+                return None
     except Exception as e:
-        print(f"❌ サムネイルダウンロードエラー: {e}")
+        logger.error("❌ サムネイルダウンロードエラー: %s", e, extra={'video_id': video_id})
         return None
 
-async def get_youtube_video_info(video_id: str) -> dict:
-    """YouTube APIを使用して動画情報を取得"""
+async def fetch_youtube_videos(video_ids: list[str]) -> dict:
+    """YouTube APIの videos.list で複数の動画情報を1リクエストで取得"""
     try:
         # YouTube Data API v3を使用
-        api_key = os.getenv('YOUTUBE_API_KEY')
+        api_key = config.youtube_api_key
         if not api_key:
-            print(f"⚠️ YouTube APIキーが設定されていません")
-            return None
+            logger.warning("⚠️ YouTube APIキーが設定されていません")
+            return {}
         
-        url = f"https://www.googleapis.com/youtube/v3/videos"
         params = {
             'part': 'snippet,contentDetails,statistics',
-            'id': video_id,
+            'id': ','.join(video_ids),
             'key': api_key
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if data.get('items'):
-                        item = data['items'][0]
-                        snippet = item['snippet']
-                        return {
-                            'title': snippet.get('title', ''),
-                            'channel': snippet.get('channelTitle', ''),
-                            'published_at': snippet.get('publishedAt', ''),
-                            'thumbnails': snippet.get('thumbnails', {}),
-                            'tags': snippet.get('tags', []),
-                            'category_id': snippet.get('categoryId', ''),
-                            'default_language': snippet.get('defaultLanguage', ''),
-                            'default_audio_language': snippet.get('defaultAudioLanguage', '')
-                        }
-                    else:
-                        print(f"⚠️ 動画情報が見つかりません: {video_id}")
-                        return None
-                else:
-                    print(f"❌ YouTube API エラー: {response.status}")
-                    return None
-    except Exception as e:
-        print(f"❌ YouTube動画情報取得エラー: {e}")
-        return None
-
-def extract_youtube_video_id(text: str) -> str:
-    """テキストからYouTubeのビデオIDを抽出"""
-    print(f"🔍 ===== extract_youtube_video_id開始 =====")
-    print(f"🔍 入力テキスト: {repr(text)}")
-    print(f"🔍 テキスト長: {len(text)}")
-    print(f"🔍 テキストの型: {type(text)}")
-    
-    youtube_patterns = [
-        r'https?://(?:www\.)?youtube\.com/shorts/([a-zA-Z0-9_-]+)',
-        r'https?://(?:www\.)?youtube\.com/watch\?v=([a-zA-Z0-9_-]+)',
-        r'https?://(?:www\.)?youtu\.be/([a-zA-Z0-9_-]+)'
-    ]
-    
-    print(f"🔍 検索パターン数: {len(youtube_patterns)}")
-    
-    for i, pattern in enumerate(youtube_patterns):
-        print(f"🔍 パターン {i+1} を試行: {pattern}")
-        print(f"🔍 正規表現オブジェクト: {re.compile(pattern)}")
+        session = await get_http_session()
+        with stage_latency.time('youtube_lookup'):
+            async with session.get(YOUTUBE_API_URL, params=params) as response:
+                if response.status != 200:
+                    logger.error("❌ YouTube API エラー: %d", response.status)
+                    return {}
+                data = await response.json()
         
-        match = re.search(pattern, text)
-        print(f"🔍 マッチ結果: {match}")
+        videos = {}
+        for item in data.get('items', []):
+            snippet = item['snippet']
+            video_info = {
+                'title': snippet.get('title', ''),
+                'channel': snippet.get('channelTitle', ''),
+                'published_at': snippet.get('publishedAt', ''),
+                'thumbnails': snippet.get('thumbnails', {}),
+                'tags': snippet.get('tags', []),
+                'category_id': snippet.get('categoryId', ''),
+                'default_language': snippet.get('defaultLanguage', ''),
+                'default_audio_language': snippet.get('defaultAudioLanguage', '')
+            }
+            youtube_info_cache.set(item['id'], video_info)
+            videos[item['id']] = video_info
         
-        if match:
-            video_id = match.group(1)
-            print(f"🔍 ✅ マッチ成功: video_id={video_id}")
-            print(f"🔍 マッチ位置: {match.start()} - {match.end()}")
-            print(f"🔍 マッチした文字列: {match.group(0)}")
-            return video_id
-        else:
-            print(f"🔍 ❌ パターン {i+1} にマッチしませんでした")
-    
-    print(f"🔍 ❌ すべてのパターンにマッチしませんでした")
-    print(f"🔍 ===== extract_youtube_video_id終了 =====")
-    return None
+        for video_id in video_ids:
+            if video_id not in videos:
+                logger.warning("⚠️ 動画情報が見つかりません: %s", video_id)
+        return videos
+    except Exception as e:
+        logger.error("❌ YouTube動画情報取得エラー: %s", e)
+        return {}
 
-async def customize_youtube_display(text: str, video_id: str = None) -> str:
-    """YouTubeリンクの表示をカスタマイズ"""
-    print(f"🔍 ===== customize_youtube_display開始 =====")
-    print(f"🔍 入力テキスト: {repr(text)}")
-    print(f"🔍 テキスト長: {len(text)}")
-    print(f"🔍 video_id: {video_id}")
-    print(f"🔍 video_idの型: {type(video_id)}")
-    
-    if not video_id:
-        print(f"🔍 ❌ video_idがNoneです")
-        print(f"🔍 ===== customize_youtube_display終了（早期リターン） =====")
-        return text
-    
-    print(f"🔍 ✅ video_idが有効です: {video_id}")
-    
-    # Misskeyの自動埋め込みを完全に防ぐ根本的対策
-    # URLを完全に無効化してプレーンテキストで表示
-    
-    # 元のURLを保存
-    original_urls = []
-    print(f"🔍 URL検索を開始します")
-    
-    # 実際のURLパターンに合わせて検索
-    actual_url = f"https://youtube.com/shorts/{video_id}"
-    actual_url_with_params = f"https://youtube.com/shorts/{video_id}?si="
-    
-    print(f"🔍 検索対象URL1: {actual_url}")
-    print(f"🔍 検索対象URL2: {actual_url_with_params}")
-    
-    # 部分一致で検索
-    if actual_url in text:
-        print(f"🔍 ✅ 完全一致URLを発見: {actual_url}")
-        original_urls.append(actual_url)
-    elif any(url in text for url in [f"https://youtube.com/shorts/{video_id}", f"https://www.youtube.com/shorts/{video_id}", f"https://youtu.be/{video_id}"]):
-        # 部分一致で検索
-        for pattern in [f"https://youtube.com/shorts/{video_id}", f"https://www.youtube.com/shorts/{video_id}", f"https://youtu.be/{video_id}"]:
-            if pattern in text:
-                print(f"🔍 ✅ 部分一致URLを発見: {pattern}")
-                original_urls.append(pattern)
-                break
-    else:
-        print(f"🔍 ❌ どのURLパターンにも一致しません")
-    
-    print(f"🔍 検出されたURL数: {len(original_urls)}")
-    print(f"🔍 検出されたURL一覧: {original_urls}")
+class YouTubeBatcher:
+    """短時間に届いた動画情報の要求をまとめて1回の videos.list にする"""
+    def __init__(self, window: float = config.youtube_batch_window, max_batch: int = config.youtube_batch_size):
+        self.window = window
+        self.max_batch = max_batch
+        self.pending: dict[str, asyncio.Future] = {}  # 結果が出るまで（API呼び出し中も含む）の要求
+        self.queued: list[str] = []                    # まだAPIに送っていない動画ID
+        self.tasks: set[asyncio.Task] = set()
+        self.flush_handle: asyncio.TimerHandle | None = None
+        self.stats = {'requests': 0, 'api_calls': 0}
     
-    # 元のテキストからYouTube URLを削除
-    modified_text = text
-    print(f"🔍 元のテキスト: {repr(modified_text)}")
+    def get(self, video_id: str) -> asyncio.Future:
+        """動画情報の要求を登録（同じIDの要求は、API呼び出し中のものも含めて1つにまとめる）"""
+        self.stats['requests'] += 1
+        future = self.pending.get(video_id)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self.pending[video_id] = future
+            self.queued.append(video_id)
+            if len(self.queued) >= self.max_batch:
+                self.flush()
+            elif self.flush_handle is None:
+                self.flush_handle = loop.call_later(self.window, self.flush)
+        return future
     
-    # 検出されたURLを削除
-    for url in original_urls:
-        modified_text = modified_text.replace(url, "")
-        print(f"🔍 URL削除: {url}")
+    def flush(self):
+        """溜まった要求をまとめてAPIに送る"""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.queued:
+            return
+        batch, self.queued = self.queued, []
+        # タスクへの参照を持っておかないと、実行中にガベージコレクションされることがある
+        task = asyncio.create_task(self._resolve(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
     
-    # 特殊文字で囲まれたURLも削除
-    for url in original_urls:
-        modified_text = modified_text.replace(f"【{url}】", "")
-        print(f"🔍 特殊文字URL削除: 【{url}】")
+    async def _resolve(self, batch: list[str]):
+        self.stats['api_calls'] += 1
+        videos = {}
+        try:
+            videos = await fetch_youtube_videos(batch)
+        except Exception as e:
+            logger.error("❌ YouTube動画情報の一括取得エラー: %s", e)
+        finally:
+            # 取り消された場合も含め、待っている要求は必ず解決して pending から外す
+            for video_id in batch:
+                future = self.pending.pop(video_id)
+                if not future.done():
+                    future.set_result(videos.get(video_id))
+
+youtube_batcher = YouTubeBatcher()
+
+async def get_youtube_video_info(video_id: str) -> dict:
+    """YouTube APIを使用して動画情報を取得（キャッシュ・一括取得を経由）"""
+    cached = youtube_info_cache.get(video_id)
+    if cached is not None:
+        return cached
+    return await youtube_batcher.get(video_id)
+
+# ===== リンク書き換えエンジン =====
+# 対応するYouTube URLの全形式（shorts / watch（追加パラメータ付き） / youtu.be / m.youtube / music.youtube / live / embed）を
+# 1つの正規表現にまとめてimport時にコンパイルし、テキストを1回走査するだけでURL除去とID抽出を同時に行う。
+YOUTUBE_URL_RE = re.compile(
+    r"""
+    (?P<open>【)?                                  # 【URL】形式で囲まれている場合は括弧ごと除去
+    https?://
+    (?:
+        (?:(?:www|m|music)\.)?youtube\.com/
+        (?:
+            (?:shorts|live|embed)/
+          | watch\?(?:[-\w.~=%&]*?&)?v=            # v= より前に別のパラメータがあってもよい
+        )
+      | youtu\.be/
+    )
+    (?P<id>[a-zA-Z0-9_-]+)
+    (?:[?&\#][-\w.~=&%\#]*)?                       # ?si= や &t= などの残りのパラメータ（URLに使えるASCII文字だけ。
+                                                  # 直後に空白なしで続く「、」や「)」などの本文は残す）
+    (?(open)】)
+    """,
+    re.VERBOSE | re.ASCII
+)
+BLANK_LINES_RE = re.compile(r'\n{2,}')
+
+def rewrite_youtube_links(text: str) -> tuple[str, list[str]]:
+    """YouTube URLを除去したテキストと、出現順のビデオID一覧（重複除外）を1回の走査で返す"""
+    # 大半のメッセージはYouTubeリンクを含まないので、正規表現を使わずに判定して返す
+    if 'youtu' not in text:
+        return text, []
+    video_ids: dict[str, None] = {}
     
-    # ?si=パラメータも削除
-    modified_text = re.sub(r'\?si=[a-zA-Z0-9_-]+', '', modified_text)
-    print(f"🔍 ?si=パラメータ削除完了")
+    def strip_url(match: re.Match) -> str:
+        video_ids.setdefault(match.group('id'))
+        return ''
     
+    stripped = YOUTUBE_URL_RE.sub(strip_url, text)
+    if not video_ids:
+        return text, []
     # 余分な改行を削除してテキストを短縮
-    final_text = modified_text.replace('\n\n\n', '\n').replace('\n\n', '\n').strip()
-    
-    # YouTube動画の場合は、カスタムカードとURLを追加
-    if video_id:
-        # 動画情報を取得
-        video_info = await get_youtube_video_info(video_id)
-        custom_card = create_discord_style_card(video_id, video_info)
-        # Misskeyプラットフォームの制限を考慮した最適化されたYouTube URL
-        youtube_url = f"https://youtu.be/{video_id}"
-        
-        final_text = f"{final_text}\n\n{custom_card}\n{youtube_url}"
-        print(f"🔍 YouTube動画検出: {video_id} - カスタムカードとURL追加")
-        print(f"🔍 カスタムカード: {custom_card}")
-    
-    print(f"🔍 最終的なテキスト: {repr(final_text)}")
-    return final_text
+    return BLANK_LINES_RE.sub('\n', stripped).strip(), list(video_ids)
 
 def create_custom_youtube_card(video_id: str, video_info: dict = None) -> str:
     """カスタムYouTubeカードを作成"""
@@ -299,26 +839,26 @@ def create_custom_youtube_card(video_id: str, video_info: dict = None) -> str:
 """
     return card
 
+# 絵文字のUnicode範囲（import時に一度だけコンパイル）
+EMOJI_RE = re.compile(
+    "["
+    "\U0001F600-\U0001F64F"  # emoticons
+    "\U0001F300-\U0001F5FF"  # symbols & pictographs
+    "\U0001F680-\U0001F6FF"  # transport & map symbols
+    "\U0001F1E0-\U0001F1FF"  # flags (iOS)
+    "\U00002702-\U000027B0"  # dingbats
+    "\U000024C2-\U0001F251"  # enclosed characters
+    "\U0001F900-\U0001F9FF"  # supplemental symbols and pictographs
+    "\U0001FA70-\U0001FAFF"  # symbols and pictographs extended-A
+    "\U0001F004"             # mahjong tile red dragon
+    "\U0001F0CF"             # playing card black joker
+    "\U0001F170-\U0001F251"  # enclosed alphanumeric supplement
+    "]+", flags=re.UNICODE
+)
+
 def remove_emojis(text: str) -> str:
     """テキストから絵文字を削除"""
-    import re
-    # 絵文字のUnicode範囲を指定して削除
-    emoji_pattern = re.compile(
-        "["
-        "\U0001F600-\U0001F64F"  # emoticons
-        "\U0001F300-\U0001F5FF"  # symbols & pictographs
-        "\U0001F680-\U0001F6FF"  # transport & map symbols
-        "\U0001F1E0-\U0001F1FF"  # flags (iOS)
-        "\U00002702-\U000027B0"  # dingbats
-        "\U000024C2-\U0001F251"  # enclosed characters
-        "\U0001F900-\U0001F9FF"  # supplemental symbols and pictographs
-        "\U0001FA70-\U0001FAFF"  # symbols and pictographs extended-A
-        "\U0001F004"             # mahjong tile red dragon
-        "\U0001F0CF"             # playing card black joker
-        "\U0001F170-\U0001F251"  # enclosed alphanumeric supplement
-        "]+", flags=re.UNICODE
-    )
-    return emoji_pattern.sub('', text).strip()
+    return EMOJI_RE.sub('', text).strip()
 
 def create_discord_style_card(video_id: str, video_info: dict = None) -> str:
     """Discord風のカードを作成（最適化版）"""
@@ -333,9 +873,370 @@ def create_discord_style_card(video_id: str, video_info: dict = None) -> str:
     # シンプルなテキストで、OGPとの競合を避ける
     return f"🎵 {title} - {channel} 🎬"
 
-async def post_to_misskey(text: str, media_ids=None):
+# ===== リンクプレビュー =====
+# プロバイダーごとに対象のリンクを書き換え、取得した情報からカードを作ってテキストの末尾に付ける。
+# 全てのリンクの情報取得を同時に開始し、LINK_PREVIEW_DEADLINE 秒までに届かなかった分は情報なしで投稿する
+# （取得自体は裏で続け、キャッシュに入れて次回以降に使う）。
+
+class LinkPreviewProvider(ABC):
+    """リンクプレビューのプロバイダー（対象リンクの抽出・情報の取得・カードの作成）"""
+    name = ''
+    
+    @abstractmethod
+    def rewrite(self, text: str) -> tuple[str, list[str]]:
+        """対象のリンクを書き換えたテキストと、情報を取得するキーの一覧を返す"""
+    
+    @abstractmethod
+    async def fetch(self, key: str) -> dict | None:
+        """キー1件分の情報を取得（取得できなければNone）"""
+    
+    @abstractmethod
+    def render(self, key: str, info: dict | None) -> str | None:
+        """カードの文字列を作成（Noneならカードを付けない）"""
+
+class YouTubePreview(LinkPreviewProvider):
+    """YouTubeの動画リンク（Misskeyの自動埋め込みを避けるため、URLを除去してカードと短縮URLに置き換える）"""
+    name = 'youtube'
+    
+    def rewrite(self, text: str) -> tuple[str, list[str]]:
+        return rewrite_youtube_links(text)
+    
+    async def fetch(self, video_id: str) -> dict | None:
+        # 他のリンクの取得と同時に待つ間に、同じ時期の要求が1回の videos.list にまとめられる
+        return await get_youtube_video_info(video_id)
+    
+    def render(self, video_id: str, info: dict | None) -> str:
+        custom_card = create_discord_style_card(video_id, info)
+        logger.debug("🔍 YouTube動画検出: %s - カスタムカード: %s", video_id, custom_card)
+        # Misskeyプラットフォームの制限を考慮した最適化されたYouTube URL
+        return f"{custom_card}\nhttps://youtu.be/{video_id}"
+
+# 空白か日本語の句読点・括弧までをURLとみなす（日本語のパスはそのまま含める）
+URL_RE = re.compile(r'https?://[^\s<>"、。，．！？「」『』（）【】〈〉《》]+')
+URL_TRAILING_PUNCTUATION = ".,;:!?'*"
+
+def trim_url(url: str) -> str:
+    """URLの末尾に続く句読点と、対応する開き括弧のない閉じ括弧を取り除く"""
+    while url:
+        last = url[-1]
+        if (last in URL_TRAILING_PUNCTUATION
+                or (last == ')' and url.count(')') > url.count('('))
+                or (last == ']' and url.count(']') > url.count('['))):
+            url = url[:-1]
+        else:
+            break
+    return url
+META_TAG_RE = re.compile(r'<meta\s[^>]*>', re.IGNORECASE)
+META_ATTR_RE = re.compile(r'([\w:-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+TITLE_TAG_RE = re.compile(r'<title[^>]*>(.*?)</title>', re.IGNORECASE | re.DOTALL)
+OPENGRAPH_MAX_BYTES = 256 * 1024  # <head> を読めれば十分なので、大きなページも先頭だけ読む
+
+def parse_opengraph(page: str) -> dict:
+    """HTMLからOGPのタイトル・サイト名を取り出す（og:title がなければ <title>）"""
+    info = {}
+    for tag in META_TAG_RE.findall(page):
+        attrs = {name.lower(): double or single for name, double, single in META_ATTR_RE.findall(tag)}
+        key = (attrs.get('property') or attrs.get('name') or '').lower()
+        if key in ('og:title', 'og:site_name') and attrs.get('content'):
+            info.setdefault(key[3:], attrs['content'])
+    if 'title' not in info and (match := TITLE_TAG_RE.search(page)):
+        info['title'] = match.group(1)
+    # 改行や連続する空白を詰めて1行にする
+    return {key: ' '.join(html.unescape(value).split()) for key, value in info.items() if value.strip()}
+
+class OpenGraphPreview(LinkPreviewProvider):
+    """一般のリンク（ページのOGPからタイトルとサイト名のカードを作る。URLはそのまま残す）"""
+    name = 'opengraph'
+    
+    def __init__(self):
+        self.inflight: dict[str, asyncio.Task] = {}  # 取得中のURL（同じURLの取得は1回にまとめる）
+    
+    def rewrite(self, text: str) -> tuple[str, list[str]]:
+        if 'http' not in text:
+            return text, []
+        urls = list(dict.fromkeys(trim_url(url) for url in URL_RE.findall(text)))
+        return text, urls[:config.link_preview_max_links]
+    
+    async def fetch(self, url: str) -> dict | None:
+        cached = link_preview_cache.get(url)
+        if cached is not None:
+            return cached or None
+        task = self.inflight.get(url)
+        if task is None:
+            task = asyncio.create_task(self._fetch(url))
+            self.inflight[url] = task
+            task.add_done_callback(lambda _: self.inflight.pop(url, None))
+        # 締め切りで待つのをやめても、取得は止めずにキャッシュへ入れる
+        return await asyncio.shield(task)
+    
+    async def _fetch(self, url: str) -> dict:
+        info = {}
+        try:
+            session = await get_http_session()
+            timeout = aiohttp.ClientTimeout(total=config.link_preview_timeout)
+            async with session.get(url, timeout=timeout, headers={'Accept': 'text/html'}) as response:
+                if response.status == 200 and response.content_type in ('text/html', 'application/xhtml+xml'):
+                    body = b''
+                    while len(body) < OPENGRAPH_MAX_BYTES and (chunk := await response.content.read(OPENGRAPH_MAX_BYTES - len(body))):
+                        body += chunk
+                    info = parse_opengraph(body.decode(response.charset or 'utf-8', errors='replace'))
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            link_preview_stats['failed'] += 1
+            logger.debug("🔗 OGPを取得できませんでした: %s: %s", url, e)
+        # 取得できなかったページも空の結果を覚えておき、遅いサイトに毎回問い合わせない
+        link_preview_cache.set(url, info)
+        return info
+    
+    def render(self, url: str, info: dict | None) -> str | None:
+        if not info or 'title' not in info:
+            return None
+        title = info['title'] if len(info['title']) <= 100 else info['title'][:100] + '...'
+        site = info.get('site_name') or urlsplit(url).hostname
+        return f"🔗 {title} - {site}"
+
+# 使えるプロバイダー（LINK_PREVIEW_PROVIDERS で名前を指定した順に適用）
+LINK_PREVIEW_PROVIDERS = {provider.name: provider for provider in (YouTubePreview(), OpenGraphPreview())}
+link_preview_providers = [
+    LINK_PREVIEW_PROVIDERS[name] for name in config.link_preview_providers if name in LINK_PREVIEW_PROVIDERS
+]
+for name in set(config.link_preview_providers) - set(LINK_PREVIEW_PROVIDERS):
+    logger.warning("⚠️ 未対応のリンクプレビューのため無視します: %s（使えるもの: %s）", name, ', '.join(LINK_PREVIEW_PROVIDERS))
+link_preview_stats = {'links': 0, 'late': 0, 'failed': 0}
+link_preview_tasks: set[asyncio.Task] = set()  # 締め切り後も取得を続けているタスク
+
+async def enrich_links(text: str) -> str:
+    """メッセージ中のリンクをプロバイダーごとに書き換え、取得した情報のカードを付ける"""
+    rewritten = text
+    links = []
+    for provider in link_preview_providers:
+        rewritten, keys = provider.rewrite(rewritten)
+        links += [(provider, key) for key in keys]
+    if not links:
+        return text
+    link_preview_stats['links'] += len(links)
+    
+    # 全てのリンクの取得を同時に始め、締め切りまでに届いた情報だけを使う
+    tasks = [asyncio.create_task(provider.fetch(key)) for provider, key in links]
+    with stage_latency.time('link_preview'):
+        done, pending = await asyncio.wait(tasks, timeout=config.link_preview_deadline)
+    if pending:
+        link_preview_stats['late'] += len(pending)
+        logger.info("⏱️ リンク情報の取得が%.1f秒以内に終わらなかったため、%d件は情報なしで投稿します",
+                    config.link_preview_deadline, len(pending))
+        for task in pending:
+            link_preview_tasks.add(task)
+            task.add_done_callback(link_preview_tasks.discard)
+    
+    cards = []
+    for (provider, key), task in zip(links, tasks):
+        info = task.result() if task in done and task.exception() is None else None
+        card = provider.render(key, info)
+        if card is not None:
+            cards.append(card)
+    if not cards:
+        return rewritten
+    return f"{rewritten}\n\n" + "\n".join(cards)
+
+class MisskeyAPIError(Exception):
+    """Misskey APIの呼び出しが最終的に失敗したことを表す例外"""
+    def __init__(self, status: int | None, message: str, code: str | None = None):
+        super().__init__(f"{status} - {message}" if status else message)
+        self.status = status
+        self.code = code  # Misskeyのエラーコード（NO_SUCH_FILE など）
+
+class MediaRejectedError(RuntimeError):
+    """添付したDriveファイルが見つからずにノート作成が拒否されたことを表す例外（再利用したファイルがDrive側で削除されていた場合）"""
+    def __init__(self, dest_name: str):
+        super().__init__(f"添付ファイルが見つかりません ({dest_name})")
+
+class TokenBucket:
+    """クライアント側のレート制限（トークンバケット）"""
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+    
+    def pause(self, seconds: float):
+        """サーバーから制限を通知された場合、その間はトークンを払い出さない"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+    
+    async def acquire(self) -> float:
+        """トークンを1つ取得（必要なら待機）し、待機した秒数を返す"""
+        waited = 0.0
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    delay = self.blocked_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                    self.updated_at = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    delay = (1 - self.tokens) / self.rate
+                waited += delay
+                await asyncio.sleep(delay)
+
+def parse_retry_after(response: aiohttp.ClientResponse, body: dict | None) -> float | None:
+    """Retry-After / X-RateLimit-Reset ヘッダーやエラー情報から待機秒数を取得"""
+    retry_after = response.headers.get('Retry-After')
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            from email.utils import parsedate_to_datetime
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    reset = response.headers.get('X-RateLimit-Reset')
+    if reset:
+        try:
+            return max(0.0, float(reset))
+        except ValueError:
+            pass
+    info = ((body or {}).get('error') or {}).get('info') or {}
+    if isinstance(info, dict) and 'resetMs' in info:
+        return max(0.0, float(info['resetMs']) / 1000)
+    return None
+
+class MisskeyClient:
+    """レート制限・再試行付きのMisskey APIクライアント（投稿先ごとに1つ、接続プールも独立）"""
+    RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+    # 非冪等なリクエスト（ノート作成など）は、サーバーが処理していないと確実に言える場合だけ再試行する
+    UNPROCESSED_STATUSES = {429, 503}
+    
+    def __init__(self, name: str, host: str, token: str, rate: float = config.misskey_rate_limit, burst: int = config.misskey_rate_burst):
+        self.name = name
+        self.host = host.rstrip('/') if host else host
+        self.token = token
+        self.bucket = TokenBucket(rate, burst)
+        self.upload_semaphore = asyncio.Semaphore(config.upload_concurrency)
+        self.session: aiohttp.ClientSession | None = None
+        self.supports_note_update = bool(config.note_edit_endpoint)
+        self.stats = {'requests': 0, 'throttled': 0, 'retried': 0, 'failed': 0}
+    
+    def get_session(self) -> aiohttp.ClientSession:
+        """この投稿先専用のHTTPセッションを取得（未作成なら作成）"""
+        if self.session is None or self.session.closed:
+            self.session = create_http_session()
+        return self.session
+    
+    async def close(self):
+        """HTTPセッションをクローズ"""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+    
+    def backoff(self, attempt: int) -> float:
+        """ジッター付き指数バックオフ（full jitter）"""
+        return random.uniform(0, min(config.misskey_retry_max_delay, config.misskey_retry_base_delay * (2 ** attempt)))
+    
+    async def request(self, endpoint: str, payload: dict | None = None, form_factory=None,
+                      idempotent: bool = True, timeout: aiohttp.ClientTimeout | None = None) -> dict | list:
+        """APIを呼び出し、レスポンスJSONを返す（失敗時は MisskeyAPIError）
+        
+        multipartの場合は再試行のたびにボディを作り直せるよう、FormDataを返す
+        非同期関数を form_factory に渡す。
+        """
+        session = self.get_session()
+        url = f'{self.host}/api/{endpoint}'
+        attempt = 0
+        while True:
+            waited = await self.bucket.acquire()
+            if waited > 0:
+                logger.info("⏳ Misskeyレート制限のため%.2f秒待機しました: %s", waited, endpoint)
+            self.stats['requests'] += 1
+            
+            if form_factory is not None:
+                data = await form_factory()
+                data.add_field('i', self.token)
+                request_kwargs = {'data': data}
+            else:
+                request_kwargs = {'json': {**(payload or {}), 'i': self.token}}
+            if timeout is not None:
+                request_kwargs['timeout'] = timeout
+            
+            delay = None
+            try:
+                async with session.post(url, **request_kwargs) as response:
+                    try:
+                        body = await response.json(content_type=None)
+                    except (ValueError, aiohttp.ContentTypeError):
+                        body = None
+                    
+                    if response.status in (200, 204):
+                        # 残り回数が尽きていれば、次のリクエストはリセットまで待つ
+                        if response.headers.get('X-RateLimit-Remaining') == '0':
+                            reset = parse_retry_after(response, None)
+                            if reset:
+                                self.bucket.pause(reset)
+                        return body if body is not None else {}
+                    
+                    message = json.dumps(body, ensure_ascii=False) if body is not None else response.reason
+                    if response.status == 429:
+                        self.stats['throttled'] += 1
+                        delay = parse_retry_after(response, body)
+                        if delay is not None:
+                            self.bucket.pause(delay)
+                    
+                    retryable = self.RETRYABLE_STATUSES if idempotent else self.UNPROCESSED_STATUSES
+                    # 長時間の待機を指示された場合はここで待たず、呼び出し元（ジョブキュー）の再試行に任せる
+                    too_long = delay is not None and delay > config.misskey_retry_max_delay
+                    if response.status not in retryable or attempt >= config.misskey_max_retries or too_long:
+                        self.stats['failed'] += 1
+                        error = body.get('error') if isinstance(body, dict) else None
+                        code = error.get('code') if isinstance(error, dict) else None
+                        raise MisskeyAPIError(response.status, message, code)
+                    logger.warning("⚠️ Misskey API %s が %d を返しました: %s", endpoint, response.status, message)
+            except aiohttp.ClientConnectorError as e:
+                # 接続自体が確立できていないので、非冪等なリクエストでも再試行してよい
+                if attempt >= config.misskey_max_retries:
+                    self.stats['failed'] += 1
+                    raise MisskeyAPIError(None, str(e)) from e
+                logger.warning("⚠️ Misskeyに接続できません: %s", e)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # 送信後に切断された場合、非冪等なリクエストは二重実行を避けるため再試行しない
+                if not idempotent or attempt >= config.misskey_max_retries:
+                    self.stats['failed'] += 1
+                    raise MisskeyAPIError(None, f"{type(e).__name__}: {e}") from e
+                logger.warning("⚠️ Misskey API %s の通信エラー: %s: %s", endpoint, type(e).__name__, e)
+            
+            if delay is None:
+                delay = self.backoff(attempt)
+            attempt += 1
+            self.stats['retried'] += 1
+            logger.info("🔁 Misskey API %s を%.2f秒後に再試行します（%d/%d）", endpoint, delay, attempt, config.misskey_max_retries)
+            await asyncio.sleep(delay)
+
+misskey_clients = {
+    dest.name: MisskeyClient(dest.name, dest.host, dest.token, dest.rate_limit, dest.burst)
+    for dest in config.destinations
+}
+# チャンネルID -> 投稿先の一覧（起動時に作っておき、ジョブごとには組み立てない）
+channel_destinations = {
+    channel_id: [misskey_clients[name] for name in names if name in misskey_clients]
+    for channel_id, names in config.channel_routes.items()
+}
+
+def destinations_for_channel(channel_id: int) -> list[MisskeyClient]:
+    """チャンネルのメッセージを投稿する先の一覧"""
+    destinations = channel_destinations.get(channel_id)
+    if destinations is None:
+        return list(misskey_clients.values())
+    return destinations
+
+async def close_misskey_clients():
+    """全ての投稿先のHTTPセッションをクローズ"""
+    await asyncio.gather(*(dest.close() for dest in misskey_clients.values()))
+
+async def post_to_misskey(dest: MisskeyClient, text: str, media_ids=None, reply_id: str | None = None) -> dict | None:
+    """Misskeyにノートを投稿し、作成されたノートを返す（reply_id を指定すると返信として投稿）"""
     payload = {
-        'i': MISSKEY_TOKEN,
         'text': text,
         'visibility': 'public',
         'noExtractMentions': True,  # メンションの自動抽出を無効化
@@ -353,161 +1254,1554 @@ async def post_to_misskey(text: str, media_ids=None):
     }
     if media_ids:
         payload['mediaIds'] = media_ids
+    if reply_id:
+        payload['replyId'] = reply_id
+    
+    try:
+        with stage_latency.time('notes_create'):
+            result = await dest.request('notes/create', payload, idempotent=False)
+    except MisskeyAPIError as e:
+        logger.error("❌ Misskey投稿失敗: %s", e, extra={'destination': dest.name})
+        if media_ids and e.code == 'NO_SUCH_FILE':
+            raise MediaRejectedError(dest.name) from e
+        return None
+    note = result.get('createdNote') or {}
+    logger.info("📤 Misskey投稿成功: %s", note.get('id'), extra={'note_id': note.get('id'), 'destination': dest.name})
+    return note
+
+async def upload_to_misskey_drive(dest: MisskeyClient, file_data: bytes, filename: str, content_type: str | None = None) -> str | None:
+    """MisskeyのDriveにファイルをアップロード（content_type省略時は内容から判定）"""
+    content_type = content_type or detect_content_type(file_data) or 'application/octet-stream'
+    
+    async def build_form():
+        data = aiohttp.FormData()
+        data.add_field('file', file_data, filename=filename, content_type=content_type)
+        return data
     
-    async with aiohttp.ClientSession() as session:
-        async with session.post(f'{MISSKEY_HOST}/api/notes/create', json=payload) as response:
-            try:
-                response_text = await response.text()
-                print(f'📤 Misskey投稿結果: {response.status} - {response_text}')
-                return response
-            except Exception as e:
-                print(f'⚠️ レスポンス読み取りエラー: {e}')
-                print(f'📤 Misskey投稿結果: {response.status} - レスポンス読み取り失敗')
-                return response
-
-async def upload_to_misskey_drive(file_data: bytes, filename: str) -> str | None:
-    """MisskeyのDriveに画像をアップロード"""
     try:
-        async with aiohttp.ClientSession() as session:
-            data = aiohttp.FormData()
-            data.add_field('i', MISSKEY_TOKEN)
-            data.add_field('file', file_data, filename=filename, content_type='image/jpeg')
+        with stage_latency.time('drive_upload'):
+            result = await dest.request('drive/files/create', form_factory=build_form, idempotent=False)
+        return result.get('id')
+    except MisskeyAPIError as e:
+        logger.error("❌ Misskey Driveアップロード失敗: %s", e, extra={'file': filename, 'destination': dest.name})
+        return None
+    except Exception as e:
+        logger.error("❌ Misskey Driveアップロードエラー: %s", e, extra={'file': filename, 'destination': dest.name})
+        return None
+
+async def stream_to_misskey_drive(dest: MisskeyClient, source_url: str, filename: str, content_type: str) -> tuple[str | None, str | None]:
+    """Discord CDNのレスポンスをチャンク単位でそのままMisskeyのDriveへ転送し、(ファイルID, MD5) を返す"""
+    session = await get_http_session()
+    # 大きなファイルは全体タイムアウトではなく無通信時間で打ち切る
+    timeout = aiohttp.ClientTimeout(total=None, connect=config.http_connect_timeout, sock_read=config.http_total_timeout)
+    sources: list[aiohttp.ClientResponse] = []
+    transferred = 0
+    digest = hashlib.md5()
+    
+    async def build_form():
+        # 再試行のたびにCDNから取得し直す（ストリームは巻き戻せないため）
+        nonlocal transferred, digest
+        transferred = 0
+        digest = hashlib.md5()
+        source = await session.get(source_url, timeout=timeout)
+        sources.append(source)
+        if source.status != 200:
+            raise MisskeyAPIError(None, f"添付ファイル取得失敗: {source.status} - {filename}")
+        
+        async def relay_chunks():
+            nonlocal transferred
+            async for chunk in source.content.iter_chunked(config.stream_chunk_size):
+                transferred += len(chunk)
+                digest.update(chunk)
+                yield chunk
+        
+        data = aiohttp.FormData()
+        data.add_field('file', relay_chunks(), filename=filename, content_type=content_type)
+        return data
+    
+    try:
+        # ストリーミングではCDNからの取得とアップロードが同時に進むため、まとめて drive_upload として記録
+        with stage_latency.time('drive_upload'):
+            result = await dest.request('drive/files/create', form_factory=build_form, idempotent=False, timeout=timeout)
+        logger.info("🌊 ストリーミング転送完了: %s", filename, extra={'file': filename, 'bytes': transferred, 'destination': dest.name})
+        return result.get('id'), digest.hexdigest()
+    except MisskeyAPIError as e:
+        logger.error("❌ Misskey Driveアップロード失敗: %s", e, extra={'file': filename, 'destination': dest.name})
+        return None, None
+    except Exception as e:
+        logger.error("❌ Misskey Driveストリーミングアップロードエラー: %s", e, extra={'file': filename, 'destination': dest.name})
+        return None, None
+    finally:
+        for source in sources:
+            source.release()
+
+# ===== Driveファイルの重複排除インデックス =====
+# 内容のMD5（MisskeyのDriveと同じハッシュ）とDiscordの添付ファイルIDから、アップロード済みのDriveファイルIDを引く。
+# Driveは投稿先ごとに別なので、投稿先の名前（host列）ごとに管理する。
+
+drive_dedup_stats = {'attachment_hits': 0, 'hash_hits': 0, 'remote_hits': 0, 'stale': 0, 'misses': 0}
+
+def lookup_drive_file(dest: MisskeyClient, attachment_id: int | None = None, md5: str | None = None) -> tuple[str, str] | None:
+    """インデックスから (DriveファイルID, MD5) を取得"""
+    if attachment_id is not None:
+        row = get_db().execute(
+            "SELECT file_id, md5 FROM drive_files WHERE host = ? AND attachment_id = ?",
+            (dest.name, attachment_id)
+        ).fetchone()
+        if row is not None:
+            return row[0], row[1]
+    if md5 is not None:
+        row = get_db().execute(
+            "SELECT file_id, md5 FROM drive_files WHERE host = ? AND md5 = ?",
+            (dest.name, md5)
+        ).fetchone()
+        if row is not None:
+            return row[0], row[1]
+    return None
+
+def record_drive_file(dest: MisskeyClient, md5: str, file_id: str, attachment_id: int | None = None):
+    """アップロード済みのDriveファイルをインデックスに登録"""
+    get_db().execute(
+        "INSERT OR REPLACE INTO drive_files (host, md5, file_id, attachment_id, created_at) VALUES (?, ?, ?, ?, ?)",
+        (dest.name, md5, file_id, attachment_id, time.time())
+    )
+
+def forget_drive_file(dest: MisskeyClient, md5: str):
+    """Drive側で削除されたファイルをインデックスから外す"""
+    get_db().execute("DELETE FROM drive_files WHERE host = ? AND md5 = ?", (dest.name, md5))
+
+def forget_drive_file_ids(dest: MisskeyClient, file_ids: list[str]):
+    """ノート作成で拒否されたファイルIDをインデックスから外す"""
+    placeholders = ','.join('?' * len(file_ids))
+    get_db().execute(f"DELETE FROM drive_files WHERE host = ? AND file_id IN ({placeholders})", (dest.name, *file_ids))
+
+async def reupload_rejected_media(dest: MisskeyClient, candidates: list[str], attachments: list[dict], prepared: dict,
+                                  reused: set[str]) -> list[str] | None:
+    """再利用したファイルのうちDrive側で削除されていたものだけ登録を消し、アップロードし直したファイルIDを返す（なければNone）"""
+    missing = [file_id for file_id in candidates if not await drive_file_exists(dest, file_id)]
+    if not missing:
+        return None
+    forget_drive_file_ids(dest, missing)
+    drive_dedup_stats['stale'] += len(missing)
+    logger.warning("♻️ 再利用したファイルが削除されていたため、アップロードし直します: %s", missing, extra={'destination': dest.name})
+    # 残っているファイルはインデックスから再利用されるので、アップロードし直すのは削除されていた分だけ
+    return await upload_attachments(dest, attachments, prepared, reused)
+
+async def find_drive_file_by_hash(dest: MisskeyClient, md5: str) -> list[str]:
+    """Misskeyの drive/files/find-by-hash で同じ内容のファイルIDを検索"""
+    try:
+        files = await dest.request('drive/files/find-by-hash', {'md5': md5})
+    except MisskeyAPIError as e:
+        logger.warning("⚠️ Driveファイルのハッシュ検索に失敗しました: %s", e)
+        return []
+    return [file['id'] for file in files if isinstance(file, dict) and 'id' in file]
+
+async def drive_file_exists(dest: MisskeyClient, file_id: str) -> bool:
+    """DriveファイルがMisskey側に残っているか（確認できない場合は残っているとみなす）"""
+    try:
+        await dest.request('drive/files/show', {'fileId': file_id})
+        return True
+    except MisskeyAPIError as e:
+        return e.status is None or e.status >= 500
+
+async def resolve_uploaded_file(dest: MisskeyClient, attachment_id: int | None = None, md5: str | None = None,
+                                upload_md5: str | None = None) -> str | None:
+    """投稿先にアップロード済みなら既存のDriveファイルIDを返す（なければNone）
+
+    インデックスは元のファイルの md5 で引き、Drive側は実際にアップロードする内容の upload_md5
+    （画像を変換した場合は変換後のハッシュ。省略時は md5）で検索する。
+    """
+    if not config.drive_dedup:
+        return None
+    hit = lookup_drive_file(dest, attachment_id, md5)
+    if hit is not None:
+        file_id, known_md5 = hit
+        # Drive側で削除されていないか確認してから再利用する
+        if config.drive_dedup_remote and not await drive_file_exists(dest, file_id):
+            drive_dedup_stats['stale'] += 1
+            forget_drive_file(dest, known_md5)
+        else:
+            drive_dedup_stats['attachment_hits' if md5 is None else 'hash_hits'] += 1
+            return file_id
+    if md5 is not None and config.drive_dedup_remote:
+        remote_ids = await find_drive_file_by_hash(dest, upload_md5 or md5)
+        if remote_ids:
+            drive_dedup_stats['remote_hits'] += 1
+            record_drive_file(dest, md5, remote_ids[0], attachment_id)
+            return remote_ids[0]
+    return None
+
+# ===== 画像の変換（縮小・再エンコード・メタデータ除去） =====
+
+# 先頭バイトによるファイル形式の判定（Discordの申告や拡張子ではなく実際の内容で判定する）
+MAGIC_NUMBERS = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+    (b'\x1aE\xdf\xa3', 'video/webm'),
+    (b'OggS', 'audio/ogg'),
+    (b'ID3', 'audio/mpeg'),
+    (b'fLaC', 'audio/flac'),
+]
+TRANSCODABLE_TYPES = {'image/jpeg', 'image/png', 'image/webp', 'image/bmp'}  # GIFはアニメーションが失われるため変換しない
+
+def detect_content_type(data: bytes) -> str | None:
+    """ファイルの先頭バイトからMIMEタイプを判定"""
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data[4:8] == b'ftyp':
+        brand = data[8:12]
+        if brand in (b'avif', b'avis'):
+            return 'image/avif'
+        if brand in (b'heic', b'heix', b'mif1'):
+            return 'image/heic'
+        return 'video/quicktime' if brand == b'qt  ' else 'video/mp4'
+    for magic, content_type in MAGIC_NUMBERS:
+        if data.startswith(magic):
+            return content_type
+    return None
+
+def transcode_image(data: bytes, max_dimension: int, fmt: str, quality: int) -> tuple[bytes, str] | None:
+    """画像を縮小・再エンコードし、(変換後のデータ, MIMEタイプ) を返す（プロセスプールで実行。アニメーションはNone）
+
+    再エンコードでEXIFなどのメタデータは除去される（向きだけは先に画素へ反映する）。
+    """
+    import io
+    from PIL import Image, ImageOps
+    
+    with Image.open(io.BytesIO(data)) as image:
+        # アニメーションWebP・APNGは最初のフレームしか残らないので変換しない（GIFを対象外にしているのと同じ理由）
+        if getattr(image, 'is_animated', False):
+            return None
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_dimension, max_dimension))
+        if fmt == 'jpeg':
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            content_type = 'image/jpeg'
+        else:
+            fmt = 'webp'
+            if image.mode not in ('RGB', 'RGBA', 'L'):
+                image = image.convert('RGBA')
+            content_type = 'image/webp'
+        output = io.BytesIO()
+        image.save(output, format=fmt.upper(), quality=quality, optimize=True)
+    return output.getvalue(), content_type
+
+media_executor: ProcessPoolExecutor | None = None
+media_stats = {'transcoded': 0, 'skipped': 0, 'failed': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+def media_transcode_available() -> bool:
+    """画像変換が有効かつPillowが利用可能か"""
+    return config.media_transcode and importlib.util.find_spec('PIL') is not None
+
+def shutdown_media_executor():
+    """画像変換用のプロセスプールを停止"""
+    global media_executor
+    if media_executor is not None:
+        media_executor.shutdown(wait=False, cancel_futures=True)
+        media_executor = None
+
+async def prepare_media(file_data: bytes, filename: str, content_type: str) -> tuple[bytes, str, str]:
+    """アップロード前に画像を縮小・再エンコード（対象外・失敗時・小さくならない場合はそのまま返す）"""
+    global media_executor
+    if content_type not in TRANSCODABLE_TYPES or not media_transcode_available():
+        media_stats['skipped'] += 1
+        return file_data, filename, content_type
+    if media_executor is None:
+        # multiprocessingの読み込みは重いので、最初に画像を変換するときまで遅らせる
+        from concurrent.futures import ProcessPoolExecutor
+        media_executor = ProcessPoolExecutor(max_workers=config.media_workers)
+    
+    try:
+        with stage_latency.time('transcode'):
+            result = await asyncio.get_running_loop().run_in_executor(
+                media_executor, transcode_image, file_data, config.media_max_dimension, config.media_format, config.media_quality
+            )
+    except Exception as e:
+        media_stats['failed'] += 1
+        logger.warning("⚠️ 画像変換に失敗したため元のファイルをアップロードします: %s (%s)", filename, e)
+        return file_data, filename, content_type
+    
+    if result is None:
+        media_stats['skipped'] += 1
+        return file_data, filename, content_type
+    converted, converted_type = result
+    if len(converted) >= len(file_data):
+        media_stats['skipped'] += 1
+        return file_data, filename, content_type
+    
+    media_stats['transcoded'] += 1
+    media_stats['bytes_in'] += len(file_data)
+    media_stats['bytes_out'] += len(converted)
+    extension = '.jpg' if converted_type == 'image/jpeg' else '.webp'
+    logger.debug("🗜️ 画像変換: %s %d -> %d bytes", filename, len(file_data), len(converted))
+    return converted, os.path.splitext(filename)[0] + extension, converted_type
+
+async def fetch_attachment(url: str) -> bytes:
+    """Discord CDNから添付ファイルを取得"""
+    session = await get_http_session()
+    with stage_latency.time('discord_fetch'):
+        async with session.get(url) as response:
+            response.raise_for_status()
+            return await response.read()
+
+async def prepare_attachment(att: dict) -> tuple[bytes, str, bytes, str, str]:
+    """添付ファイルを取得して (元データ, MD5, アップロード用データ, ファイル名, 形式) を返す"""
+    file_bytes = await fetch_attachment(att['url'])
+    md5 = hashlib.md5(file_bytes).hexdigest()
+    # 実際の内容から形式を判定し、必要なら縮小・再エンコード
+    content_type = detect_content_type(file_bytes) or att.get('content_type') or 'application/octet-stream'
+    upload_bytes, upload_name, content_type = await prepare_media(file_bytes, att['filename'], content_type)
+    return file_bytes, md5, upload_bytes, upload_name, content_type
+
+def get_prepared_attachment(att: dict, prepared: dict) -> asyncio.Future:
+    """同じジョブの投稿先どうしで、添付ファイルの取得・変換を1回にまとめる"""
+    key = att.get('id') or att['url']
+    if key not in prepared:
+        prepared[key] = asyncio.ensure_future(prepare_attachment(att))
+    # 1つの投稿先がキャンセルされても、他の投稿先が待っている取得は止めない
+    return asyncio.shield(prepared[key])
+
+async def upload_attachment(dest: MisskeyClient, index: int, att: dict, prepared: dict, reused: set[str]) -> str | None:
+    """添付ファイル1件を投稿先のDriveにアップロード（同時実行数は投稿先ごとのセマフォで制限。再利用したIDは reused に追加）"""
+    async with dest.upload_semaphore:
+        started = time.perf_counter()
+        filename = att['filename']
+        log_extra = {'file': filename, 'destination': dest.name}
+        try:
+            logger.debug("📁 ファイル %d: %s (%d bytes)", index + 1, filename, att['size'], extra=log_extra)
+            content_type = att.get('content_type') or 'application/octet-stream'
             
-            async with session.post(
-                f'{MISSKEY_HOST}/api/drive/files/create',
-                data=data
-            ) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    return result.get('id')
+            # 同じ添付ファイルをアップロード済みなら、ダウンロードもせずに再利用
+            media_id = await resolve_uploaded_file(dest, attachment_id=att.get('id'))
+            if media_id:
+                reused.add(media_id)
+                logger.info("♻️ アップロード済みのファイルを再利用: %s -> ID: %s", filename, media_id,
+                            extra={**log_extra, 'media_id': media_id, 'dedup': 'attachment'})
+                return media_id
+            
+            # 大きなファイルはメモリに載せずストリーミング転送（投稿先ごとにCDNから取得）
+            if att['size'] > config.stream_upload_threshold:
+                if config.drive_dedup:
+                    drive_dedup_stats['misses'] += 1
+                media_id, md5 = await stream_to_misskey_drive(dest, att['url'], filename, content_type)
+                if media_id and config.drive_dedup:
+                    record_drive_file(dest, md5, media_id, att.get('id'))
+                elapsed = time.perf_counter() - started
+                if media_id:
+                    logger.info("✅ ファイルアップロード成功: %s -> ID: %s", filename, media_id,
+                                extra={**log_extra, 'media_id': media_id, 'streamed': True, 'elapsed_s': round(elapsed, 3)})
                 else:
-                    error_text = await response.text()
-                    print(f"❌ Misskey Driveアップロード失敗: {response.status} - {error_text}")
-                    return None
-    except Exception as e:
-        print(f"❌ Misskey Driveアップロードエラー: {e}")
+                    logger.error("❌ ファイルアップロード失敗: %s", filename, extra={**log_extra, 'elapsed_s': round(elapsed, 3)})
+                return media_id
+            
+            # ファイルの取得・変換（他の投稿先と共有）
+            file_bytes, md5, upload_bytes, upload_name, content_type = await get_prepared_attachment(att, prepared)
+            fetched = time.perf_counter()
+            logger.debug("📥 ファイル読み込み完了: %s %d bytes (%.2fs)", filename, len(file_bytes), fetched - started, extra=log_extra)
+            
+            # 同じ内容のファイルをアップロード済みなら再利用（別チャンネルへの再投稿など）
+            # Driveには変換後の内容が保存されるので、変換した場合はそのハッシュで検索する
+            upload_md5 = md5 if upload_bytes is file_bytes else hashlib.md5(upload_bytes).hexdigest()
+            media_id = await resolve_uploaded_file(dest, attachment_id=None, md5=md5, upload_md5=upload_md5)
+            if media_id:
+                reused.add(media_id)
+                if config.drive_dedup:
+                    record_drive_file(dest, md5, media_id, att.get('id'))
+                logger.info("♻️ 同じ内容のファイルを再利用: %s -> ID: %s", filename, media_id,
+                            extra={**log_extra, 'media_id': media_id, 'dedup': 'hash'})
+                return media_id
+            
+            # MisskeyのDriveにアップロード
+            if config.drive_dedup:
+                drive_dedup_stats['misses'] += 1
+            media_id = await upload_to_misskey_drive(dest, upload_bytes, upload_name, content_type)
+            if media_id and config.drive_dedup:
+                record_drive_file(dest, md5, media_id, att.get('id'))
+            finished = time.perf_counter()
+            if media_id:
+                logger.info("✅ ファイルアップロード成功: %s -> ID: %s", filename, media_id,
+                            extra={**log_extra, 'media_id': media_id, 'bytes': len(upload_bytes),
+                                   'fetch_s': round(fetched - started, 3), 'upload_s': round(finished - fetched, 3)})
+            else:
+                logger.error("❌ ファイルアップロード失敗: %s", filename, extra={**log_extra, 'elapsed_s': round(finished - started, 3)})
+            return media_id
+        except Exception as e:
+            logger.exception("❌ ファイル処理エラー (%s): %s", filename, e, extra=log_extra)
+            return None
+
+async def upload_attachments(dest: MisskeyClient, attachments: list[dict], prepared: dict | None = None,
+                             reused: set[str] | None = None) -> list[str]:
+    """添付ファイルを投稿先へ並列にアップロードし、元の順序でメディアIDを返す（重複排除で再利用したIDは reused に追加）"""
+    if not attachments:
+        return []
+    if prepared is None:
+        prepared = {}
+    if reused is None:
+        reused = set()
+    started = time.perf_counter()
+    results = await asyncio.gather(*(upload_attachment(dest, i, att, prepared, reused) for i, att in enumerate(attachments)))
+    media_ids = [media_id for media_id in results if media_id]
+    logger.info("📎 添付ファイル処理完了: %d/%d件", len(media_ids), len(attachments),
+                extra={'destination': dest.name, 'elapsed_s': round(time.perf_counter() - started, 3)})
+    return media_ids
+
+# ===== 永続ジョブキュー =====
+# on_messageはジョブを積むだけにして、実際の投稿はワーカーが非同期に処理する。
+# ジョブは完了するまでSQLiteに残るため、再起動やクラッシュ後も処理が再開される（at-least-once）。
+
+db: sqlite3.Connection | None = None
+queue_wakeup = asyncio.Event()
+queue_stopping = False
+worker_tasks: list[asyncio.Task] = []
+STATE_PRUNE_INTERVAL = 3600  # 常駐中に古い記録を掃除する間隔（秒）
+state_pruned_at = time.monotonic()
+
+def get_db() -> sqlite3.Connection:
+    """状態保存用のSQLite接続を取得（未作成ならスキーマも作成）"""
+    global db
+    if db is None:
+        db = sqlite3.connect(config.bot_db_path, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("PRAGMA busy_timeout=5000")
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id           INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload      TEXT    NOT NULL,
+                status       TEXT    NOT NULL DEFAULT 'pending',  -- pending / processing / dead
+                attempts     INTEGER NOT NULL DEFAULT 0,
+                available_at REAL    NOT NULL,
+                locked_at    REAL,
+                last_error   TEXT,
+                created_at   REAL    NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs(status, available_at);
+            
+            CREATE TABLE IF NOT EXISTS drive_files (
+                host          TEXT    NOT NULL,
+                md5           TEXT    NOT NULL,
+                file_id       TEXT    NOT NULL,
+                attachment_id INTEGER,
+                created_at    REAL    NOT NULL,
+                PRIMARY KEY (host, md5)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_drive_files_attachment ON drive_files(host, attachment_id);
+            
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                namespace  TEXT NOT NULL,
+                key        TEXT NOT NULL,
+                value      BLOB NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            ) WITHOUT ROWID;
+            
+            -- チャンネルごとの取り込み済み位置（これ以前のメッセージは全てキューに積んだ）
+            CREATE TABLE IF NOT EXISTS channel_cursors (
+                channel_id      INTEGER PRIMARY KEY,
+                last_message_id INTEGER NOT NULL,
+                updated_at      REAL    NOT NULL
+            );
+            
+            -- 停止中に取りこぼした可能性のある範囲（after_id より後、before_id より前。
+            -- before_id がNULLなら、起動後に常駐側がまだメッセージを受け取っていない）
+            CREATE TABLE IF NOT EXISTS backfill_gaps (
+                id         INTEGER PRIMARY KEY,
+                channel_id INTEGER NOT NULL,
+                after_id   INTEGER NOT NULL,
+                before_id  INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS idx_backfill_gaps_channel ON backfill_gaps(channel_id);
+            
+            -- DiscordのメッセージIDと投稿先ごとのノートID（編集・削除の反映用）
+            CREATE TABLE IF NOT EXISTS note_map (
+                message_id     INTEGER NOT NULL,
+                destination    TEXT    NOT NULL,
+                note_id        TEXT    NOT NULL,
+                text_md5       TEXT    NOT NULL,
+                media_ids      TEXT    NOT NULL,  -- JSON配列
+                attachment_ids TEXT    NOT NULL,  -- JSON配列（添付ファイルが減ったかの判定用）
+                reply_ids      TEXT    NOT NULL DEFAULT '[]',  -- JSON配列（長文を分割して返信で続けたノート）
+                edited_at      REAL,
+                created_at     REAL    NOT NULL,
+                PRIMARY KEY (message_id, destination)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_note_map_created ON note_map(created_at);
+            
+            -- まとめて1つのノートにしたメッセージ（編集・削除の反映時にノート全体を組み立て直す）
+            CREATE TABLE IF NOT EXISTS note_parts (
+                message_id  INTEGER PRIMARY KEY,
+                head_id     INTEGER NOT NULL,  -- 対応表（note_map）に登録した先頭のメッセージ
+                position    INTEGER NOT NULL,
+                content     TEXT    NOT NULL,
+                attachments TEXT    NOT NULL,  -- JSON配列
+                created_at  REAL    NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_note_parts_head ON note_parts(head_id, position);
+            
+            -- キューに積んだメッセージ（常駐とバックフィルで同じメッセージを二重に積まないため）
+            CREATE TABLE IF NOT EXISTS seen_messages (
+                message_id INTEGER PRIMARY KEY,
+                channel_id INTEGER NOT NULL,
+                seen_at    REAL    NOT NULL
+            );
+        """)
+        # 返信のチェーンに対応する前に作成した対応表には列を追加
+        if 'reply_ids' not in {row[1] for row in db.execute("PRAGMA table_info(note_map)")}:
+            db.execute("ALTER TABLE note_map ADD COLUMN reply_ids TEXT NOT NULL DEFAULT '[]'")
+        prune_state(db)
+    return db
+
+def prune_state(conn: sqlite3.Connection):
+    """期限切れのキャッシュや古い投稿の対応表を削除し、何年動かしても小さく保つ"""
+    conn.execute("DELETE FROM cache_entries WHERE expires_at <= ?", (time.time(),))
+    if config.note_map_retention_days > 0:
+        expired = time.time() - config.note_map_retention_days * 86400
+        conn.execute("DELETE FROM note_map WHERE created_at <= ?", (expired,))
+        conn.execute("DELETE FROM note_parts WHERE created_at <= ?", (expired,))
+    # 取り込み済み位置より前のメッセージはバックフィルで再訪しないので、記録は不要
+    # （まだバックフィルしていない範囲の中の記録は、重複を防ぐために残す）
+    conn.execute("""
+        DELETE FROM seen_messages WHERE message_id <= COALESCE(
+            (SELECT last_message_id FROM channel_cursors WHERE channel_cursors.channel_id = seen_messages.channel_id), -1)
+        AND NOT EXISTS (
+            SELECT 1 FROM backfill_gaps WHERE backfill_gaps.channel_id = seen_messages.channel_id
+              AND seen_messages.message_id > backfill_gaps.after_id
+              AND (backfill_gaps.before_id IS NULL OR seen_messages.message_id < backfill_gaps.before_id)
+        )
+    """)
+
+def prune_state_periodically():
+    """常駐中も STATE_PRUNE_INTERVAL ごとに古い記録を削除（再起動しなくても表が増え続けないように）"""
+    global state_pruned_at
+    now = time.monotonic()
+    if now - state_pruned_at < STATE_PRUNE_INTERVAL:
+        return
+    state_pruned_at = now
+    prune_state(get_db())
+
+def close_db():
+    """SQLite接続をクローズ"""
+    global db
+    if db is not None:
+        db.close()
+        db = None
+
+def enqueue_job(payload: dict, delay: float = 0) -> int:
+    """ジョブをキューに追加してワーカーを起こす（delay秒後まで処理しない）"""
+    now = time.time()
+    cursor = get_db().execute(
+        "INSERT INTO jobs (payload, available_at, created_at) VALUES (?, ?, ?)",
+        (json.dumps(payload, ensure_ascii=False), now + delay, now)
+    )
+    queue_wakeup.set()
+    return cursor.lastrowid
+
+@contextlib.contextmanager
+def db_transaction():
+    """複数の書き込みを1つのトランザクションにまとめる"""
+    conn = get_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+def advance_channel_cursor(channel_id: int, message_id: int):
+    """チャンネルの取り込み済み位置を進める（戻ることはない）"""
+    get_db().execute("""
+        INSERT INTO channel_cursors (channel_id, last_message_id, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(channel_id) DO UPDATE SET
+            last_message_id = MAX(last_message_id, excluded.last_message_id),
+            updated_at = excluded.updated_at
+    """, (channel_id, message_id, time.time()))
+
+def get_channel_cursor(channel_id: int) -> int | None:
+    """チャンネルの取り込み済み位置（未記録ならNone）"""
+    row = get_db().execute(
+        "SELECT last_message_id FROM channel_cursors WHERE channel_id = ?", (channel_id,)
+    ).fetchone()
+    return row[0] if row else None
+
+def open_backfill_gaps():
+    """起動時に、取り込み済み位置から常駐側が最初に受け取るメッセージまでを停止中の範囲として記録"""
+    # 前回の起動でメッセージを1件も受け取らずに止まった場合は、その範囲をそのまま使う
+    get_db().execute("""
+        INSERT INTO backfill_gaps (channel_id, after_id)
+        SELECT channel_id, last_message_id FROM channel_cursors
+        WHERE NOT EXISTS (
+            SELECT 1 FROM backfill_gaps WHERE backfill_gaps.channel_id = channel_cursors.channel_id AND before_id IS NULL
+        )
+    """)
+
+def advance_backfill_gap(gap_id: int, message_id: int):
+    """停止中の範囲のうち、バックフィルで取り込み済みの位置を進める"""
+    get_db().execute("UPDATE backfill_gaps SET after_id = MAX(after_id, ?) WHERE id = ?", (message_id, gap_id))
+
+def enqueue_message(message: discord.Message, gap_id: int | None = None) -> int | None:
+    """メッセージをジョブとして積む（積んだことがあればNone）。取り込み済み位置も同じトランザクションで進める
+    
+    常駐側（gap_id=None）で受け取ったメッセージは、停止中の範囲の終わりとして記録する。
+    バックフィル（gap_id を指定）では、その範囲の取り込み済みの位置を進める。
+    """
+    with db_transaction() as conn:
+        inserted = conn.execute(
+            "INSERT OR IGNORE INTO seen_messages (message_id, channel_id, seen_at) VALUES (?, ?, ?)",
+            (message.id, message.channel.id, time.time())
+        ).rowcount
+        job_id = enqueue_create(message_to_job(message)) if inserted else None
+        advance_channel_cursor(message.channel.id, message.id)
+        if gap_id is None:
+            conn.execute(
+                "UPDATE backfill_gaps SET before_id = ? WHERE channel_id = ? AND before_id IS NULL",
+                (message.id, message.channel.id)
+            )
+        else:
+            advance_backfill_gap(gap_id, message.id)
+    return job_id
+
+def claim_job() -> tuple[int, dict, int] | None:
+    """実行可能なジョブを1件取得して処理中にする（期限切れの処理中ジョブも再取得）"""
+    now = time.time()
+    row = get_db().execute(
+        """
+        UPDATE jobs SET status = 'processing', locked_at = ?, attempts = attempts + 1
+        WHERE id = (
+            SELECT id FROM jobs
+            WHERE (status = 'pending' AND available_at <= ?)
+               OR (status = 'processing' AND locked_at < ?)
+            ORDER BY id LIMIT 1
+        )
+        RETURNING id, payload, attempts
+        """,
+        (now, now, now - config.queue_lease_timeout)
+    ).fetchone()
+    if row is None:
         return None
+    return row[0], json.loads(row[1]), row[2]
+
+def update_job_payload(job_id: int, payload: dict):
+    """処理途中の結果（アップロード済みメディアIDなど）をジョブに保存"""
+    get_db().execute(
+        "UPDATE jobs SET payload = ? WHERE id = ?",
+        (json.dumps(payload, ensure_ascii=False), job_id)
+    )
+
+def renew_job_lease(job_id: int):
+    """処理中のジョブのリースを延長（長く掛かっているだけのジョブを他のワーカーに取られないように）"""
+    get_db().execute(
+        "UPDATE jobs SET locked_at = ? WHERE id = ? AND status = 'processing'",
+        (time.time(), job_id)
+    )
+
+async def keep_job_lease(job_id: int):
+    """ジョブの処理が終わるまで、リースの期限の3分の1ごとに延長し続ける"""
+    while True:
+        await asyncio.sleep(config.queue_lease_timeout / 3)
+        renew_job_lease(job_id)
+
+def complete_job(job_id: int):
+    """完了したジョブを削除"""
+    get_db().execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+def release_job(job_id: int):
+    """処理を中断したジョブを未処理に戻す（試行回数は消費しない）"""
+    get_db().execute(
+        "UPDATE jobs SET status = 'pending', locked_at = NULL, attempts = attempts - 1 WHERE id = ?",
+        (job_id,)
+    )
+
+def fail_job(job_id: int, attempts: int, error: Exception):
+    """失敗したジョブを指数バックオフで再スケジュール（上限超過でdeadにする）"""
+    if attempts >= config.queue_max_attempts:
+        get_db().execute(
+            "UPDATE jobs SET status = 'dead', locked_at = NULL, last_error = ? WHERE id = ?",
+            (str(error), job_id)
+        )
+        message_counts['failed'] += 1
+        logger.error("💀 ジョブ %d は%d回失敗したため破棄しました: %s", job_id, attempts, error, extra={'job_id': job_id})
+        return
+    delay = min(config.queue_retry_base_delay * (2 ** (attempts - 1)), 3600)
+    get_db().execute(
+        "UPDATE jobs SET status = 'pending', locked_at = NULL, available_at = ?, last_error = ? WHERE id = ?",
+        (time.time() + delay, str(error), job_id)
+    )
+    logger.warning("🔁 ジョブ %d を%.0f秒後に再試行します（%d/%d回目失敗）: %s", job_id, delay, attempts, config.queue_max_attempts, error,
+                   extra={'job_id': job_id})
+
+def requeue_stale_jobs() -> int:
+    """起動時に、前回のプロセスで処理中のまま残ったジョブを未処理に戻す"""
+    cursor = get_db().execute(
+        "UPDATE jobs SET status = 'pending', locked_at = NULL WHERE status = 'processing'"
+    )
+    return cursor.rowcount
+
+def count_pending_jobs() -> int:
+    """未完了（未処理・処理中）のジョブ数"""
+    return get_db().execute(
+        "SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'processing')"
+    ).fetchone()[0]
+
+# ===== 編集・削除の反映（DiscordのメッセージID → ノートIDの対応表） =====
+
+def text_digest(text: str) -> str:
+    """投稿したテキストのハッシュ（内容が変わったかの判定用）"""
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+def record_note(message_id: int, dest: MisskeyClient, note_ids: list[str], text: str, media_ids: list[str],
+                attachment_ids: list[int], edited_at: float | None = None):
+    """投稿したノート（分割した場合は返信も含む）を対応表に登録（編集・作り直しの場合は上書き）"""
+    get_db().execute("""
+        INSERT INTO note_map (message_id, destination, note_id, text_md5, media_ids, attachment_ids, reply_ids, edited_at, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(message_id, destination) DO UPDATE SET
+            note_id = excluded.note_id, text_md5 = excluded.text_md5, media_ids = excluded.media_ids,
+            attachment_ids = excluded.attachment_ids, reply_ids = excluded.reply_ids, edited_at = excluded.edited_at
+    """, (message_id, dest.name, note_ids[0], text_digest(text), json.dumps(media_ids), json.dumps(attachment_ids),
+          json.dumps(note_ids[1:]), edited_at, time.time()))
+
+def lookup_notes(message_id: int) -> dict[str, dict]:
+    """メッセージから投稿先ごとのノートを取得"""
+    rows = get_db().execute(
+        "SELECT destination, note_id, text_md5, media_ids, attachment_ids, reply_ids, edited_at FROM note_map WHERE message_id = ?",
+        (message_id,)
+    ).fetchall()
+    return {
+        destination: {
+            'note_id': note_id,
+            'text_md5': text_md5,
+            'media_ids': json.loads(media_ids),
+            'attachment_ids': json.loads(attachment_ids),
+            'reply_ids': json.loads(reply_ids),
+            'edited_at': edited_at,
+        }
+        for destination, note_id, text_md5, media_ids, attachment_ids, reply_ids, edited_at in rows
+    }
+
+def forget_note(message_id: int, dest: MisskeyClient):
+    """削除したノートを対応表から外す"""
+    get_db().execute("DELETE FROM note_map WHERE message_id = ? AND destination = ?", (message_id, dest.name))
+
+# まとめたジョブ（parts）に含まれるメッセージも、そのメッセージの投稿ジョブとして扱う
+CREATE_JOB_CONDITION = """
+    status IN ('pending', 'processing')
+    AND COALESCE(json_extract(payload, '$.kind'), 'create') = 'create'
+    AND (json_extract(payload, '$.message_id') = :message_id
+         OR EXISTS (SELECT 1 FROM json_each(payload, '$.parts') WHERE json_extract(value, '$.message_id') = :message_id))
+"""
+
+def find_create_job(message_id: int) -> str | None:
+    """メッセージの投稿ジョブが残っていればその状態を返す"""
+    row = get_db().execute(f"SELECT status FROM jobs WHERE {CREATE_JOB_CONDITION}", {'message_id': message_id}).fetchone()
+    return row[0] if row else None
+
+def replace_pending_create(payload: dict) -> bool:
+    """まだ処理が始まっていない投稿ジョブの内容を差し替える（まとめたジョブではそのメッセージの分だけ）"""
+    message_id = payload['message_id']
+    with db_transaction() as conn:
+        row = conn.execute(
+            f"SELECT id, payload FROM jobs WHERE status = 'pending' AND attempts = 0 AND {CREATE_JOB_CONDITION}",
+            {'message_id': message_id}
+        ).fetchone()
+        if row is None:
+            return False
+        job_id, pending = row[0], json.loads(row[1])
+        if 'parts' in pending:
+            payload = merge_parts(pending, [
+                {**part, 'content': payload['content'], 'attachments': payload['attachments']}
+                if part['message_id'] == message_id else part
+                for part in pending['parts']
+            ])
+        update_job_payload(job_id, payload)
+    return True
+
+def cancel_pending_create(message_id: int, started: bool = False) -> bool:
+    """処理待ちの投稿ジョブを取り消す（started=Trueなら再試行待ちのものも）。まとめたジョブからはそのメッセージだけ外す"""
+    condition = "status = 'pending'" if started else "status = 'pending' AND attempts = 0"
+    with db_transaction() as conn:
+        row = conn.execute(
+            f"SELECT id, payload FROM jobs WHERE {condition} AND {CREATE_JOB_CONDITION}", {'message_id': message_id}
+        ).fetchone()
+        if row is None:
+            return False
+        job_id, payload = row[0], json.loads(row[1])
+        parts = [part for part in payload.get('parts', []) if part['message_id'] != message_id]
+        if parts and not started:
+            payload['message_id'] = parts[0]['message_id']
+            update_job_payload(job_id, merge_parts(payload, parts))
+        else:
+            complete_job(job_id)
+    return True
+
+def message_to_job(message: discord.Message) -> dict:
+    """Discordメッセージをキューに保存できる形に変換"""
+    return {
+        'message_id': message.id,
+        'channel_id': message.channel.id,
+        'author_id': message.author.id,
+        'content': message.content or '',
+        'attachments': [
+            {
+                'id': att.id,
+                'url': att.url,
+                'filename': att.filename,
+                'size': att.size,
+                'content_type': att.content_type,
+            }
+            for att in message.attachments
+        ],
+    }
+
+# ===== 連続投稿のまとめ =====
+# まとめる設定のチャンネルでは、投稿ジョブを指定秒数だけ待たせ、その間に続けて投稿したメッセージを
+# 同じジョブに追記する（parts に元のメッセージごとの内容を持つ）。
+
+def merge_parts(payload: dict, parts: list[dict]) -> dict:
+    """まとめたメッセージの内容から、ジョブの本文・添付ファイルを組み立てる"""
+    payload['parts'] = parts
+    payload['content'] = '\n'.join(part['content'] for part in parts if part['content'])
+    payload['attachments'] = [att for part in parts for att in part['attachments']]
+    return payload
+
+def can_coalesce(parts: list[dict], part: dict, window: float) -> bool:
+    """処理待ちのジョブにメッセージを追記できるか（投稿者・間隔・件数・添付数・本文の長さ）"""
+    # 転送する投稿者が複数いる場合も、別の人のメッセージは1つのノートにまとめない
+    if parts[-1].get('author_id') != part['author_id']:
+        return False
+    if len(parts) >= config.coalesce_max_messages or part['posted_at'] - parts[-1]['posted_at'] > window:
+        return False
+    if sum(len(p['attachments']) for p in parts) + len(part['attachments']) > MAX_NOTE_FILES:
+        return False
+    # 分割しない場合は、まとめたせいで切り詰められることがないようにする
+    return config.split_long_notes or sum(len(p['content']) + 1 for p in parts) + len(part['content']) <= MAX_TEXT
+
+def enqueue_create(job: dict) -> int:
+    """投稿ジョブを積む（まとめる設定のチャンネルでは、直前の処理待ちのジョブへの追記を優先）"""
+    window = config.coalesce_windows.get(job['channel_id'], config.coalesce_window)
+    if window <= 0:
+        return enqueue_job(job)
+    
+    part = {
+        'message_id': job['message_id'],
+        'author_id': job.get('author_id'),
+        'content': job['content'],
+        'attachments': job['attachments'],
+        'posted_at': discord.utils.snowflake_time(job['message_id']).timestamp(),
+    }
+    # 追記するのは、チャンネルの最新の投稿ジョブがまだ処理されていない場合だけ（投稿順を保つ）
+    row = get_db().execute("""
+        SELECT id, status, attempts, payload FROM jobs
+        WHERE json_extract(payload, '$.channel_id') = ? AND json_extract(payload, '$.parts') IS NOT NULL
+          AND COALESCE(json_extract(payload, '$.kind'), 'create') = 'create'
+        ORDER BY id DESC LIMIT 1
+    """, (job['channel_id'],)).fetchone()
+    if row is not None and row[1] == 'pending' and row[2] == 0:
+        job_id, pending = row[0], json.loads(row[3])
+        if can_coalesce(pending['parts'], part, window):
+            get_db().execute(
+                "UPDATE jobs SET payload = ?, available_at = ? WHERE id = ?",
+                (json.dumps(merge_parts(pending, pending['parts'] + [part]), ensure_ascii=False), time.time() + window, job_id)
+            )
+            message_counts['coalesced'] += 1
+            logger.debug("🧺 前のメッセージとまとめて投稿します（%d件）", len(pending['parts']),
+                         extra={'job_id': job_id, 'message_id': job['message_id']})
+            return job_id
+    return enqueue_job(merge_parts(job, [part]), delay=window)
+
+def record_note_parts(head_id: int, parts: list[dict]):
+    """まとめて投稿したメッセージを記録（編集・削除の反映用。既にあれば反映済みの内容を残す）"""
+    now = time.time()
+    get_db().executemany(
+        "INSERT OR IGNORE INTO note_parts (message_id, head_id, position, content, attachments, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        [(part['message_id'], head_id, position, part['content'], json.dumps(part['attachments'], ensure_ascii=False), now)
+         for position, part in enumerate(parts)]
+    )
+
+def regroup_note_parts(message_id: int, channel_id: int, job: dict | None) -> dict | None:
+    """まとめて投稿したメッセージの編集（job=Noneなら削除）を記録し、ノート全体を編集・削除するジョブを返す（まとめていなければNone）"""
+    with db_transaction() as conn:
+        row = conn.execute("SELECT head_id FROM note_parts WHERE message_id = ?", (message_id,)).fetchone()
+        if row is None:
+            return None
+        head_id = row[0]
+        if job is None:
+            conn.execute("DELETE FROM note_parts WHERE message_id = ?", (message_id,))
+        else:
+            conn.execute(
+                "UPDATE note_parts SET content = ?, attachments = ? WHERE message_id = ?",
+                (job['content'], json.dumps(job['attachments'], ensure_ascii=False), message_id)
+            )
+        parts = [
+            {'message_id': part_id, 'content': content, 'attachments': json.loads(attachments)}
+            for part_id, content, attachments in conn.execute(
+                "SELECT message_id, content, attachments FROM note_parts WHERE head_id = ? ORDER BY position", (head_id,)
+            )
+        ]
+    if not parts:
+        return {'kind': 'delete', 'message_id': head_id, 'channel_id': channel_id}
+    # ノートの対応表は先頭のメッセージで引くので、先頭が削除されてもそのIDのまま編集する
+    edited_at = job['edited_at'] if job is not None else time.time()
+    return merge_parts({'kind': 'edit', 'message_id': head_id, 'channel_id': channel_id, 'edited_at': edited_at}, parts)
+
+async def post_thread(dest: MisskeyClient, chunks: list[str], media_ids: list[str], note_ids: list[str], on_progress=None):
+    """分割した本文を返信のチェーンとして投稿（添付ファイルは最初のノートに付け、note_ids に投稿済みのIDを追記）"""
+    # 途中で失敗しても、note_ids に残った続きから再開できる
+    for chunk in chunks[len(note_ids):]:
+        reply_id = note_ids[-1] if note_ids else None
+        note = await post_to_misskey(dest, chunk, None if note_ids else (media_ids or None), reply_id=reply_id)
+        if note is None:
+            raise RuntimeError(f"Misskey投稿失敗 ({dest.name})")
+        note_ids.append(note.get('id'))
+        if on_progress is not None:
+            on_progress()
+
+async def post_to_destination(job_id: int, dest: MisskeyClient, chunks: list[str], payload: dict, prepared: dict):
+    """1つの投稿先へ添付ファイルをアップロードしてノートを投稿"""
+    # 再試行時に同じファイルを再アップロード・二重投稿しないよう、投稿先ごとの結果をジョブに保存しておく
+    state = payload['destinations'].setdefault(dest.name, {})
+    if 'media_ids' not in state:
+        reused = set()
+        state['media_ids'] = await upload_attachments(dest, payload['attachments'], prepared, reused)
+        state['reused_media_ids'] = sorted(reused)
+        update_job_payload(job_id, payload)
+    media_ids = state['media_ids']
+    
+    logger.debug("📝 投稿: 画像%d枚 %s", len(media_ids), media_ids, extra={'job_id': job_id, 'destination': dest.name})
+    note_ids = state.setdefault('note_ids', [])
+    try:
+        await post_thread(dest, chunks, media_ids, note_ids, on_progress=lambda: update_job_payload(job_id, payload))
+    except MediaRejectedError:
+        # 重複排除で再利用したファイルが削除されていた場合は、その分だけアップロードし直して1度だけ投稿し直す
+        # （今回アップロードしたファイルしかない場合や、削除されたファイルがない場合は通常の失敗として再試行に任せる）
+        reused = set()
+        reuploaded = await reupload_rejected_media(dest, state.get('reused_media_ids', []), payload['attachments'], prepared, reused)
+        if reuploaded is None:
+            raise
+        state['media_ids'] = media_ids = reuploaded
+        state['reused_media_ids'] = sorted(reused)
+        update_job_payload(job_id, payload)
+        await post_thread(dest, chunks, media_ids, note_ids, on_progress=lambda: update_job_payload(job_id, payload))
+    if len(note_ids) > 1:
+        logger.info("🧵 長文を%d件のノートに分けて投稿しました", len(note_ids), extra={'job_id': job_id, 'destination': dest.name})
+    state['note_id'] = note_ids[0]
+    update_job_payload(job_id, payload)
+    if config.sync_edits and state['note_id']:
+        record_note(payload['message_id'], dest, note_ids, '\n'.join(chunks), media_ids,
+                    [att['id'] for att in payload['attachments']])
+
+async def render_text(job_id: int, original_text: str) -> list[str]:
+    """Discordのテキストを投稿用に変換（上限を超える場合は切り詰めるか、ノート1つ分ずつに分割）"""
+    # リンクの検出・プレビューのカード追加（YouTubeはMisskeyの自動埋め込みを回避）
+    text = await enrich_links(original_text)
+    chunks = split_for_misskey(text) if config.split_long_notes else [truncate_for_misskey(text)]
+    logger.debug("🔍 テキスト変換: %r -> %r", original_text, chunks, extra={'job_id': job_id})
+    return chunks
+
+async def process_create_job(job_id: int, payload: dict):
+    """投稿ジョブを処理（テキスト変換 → 投稿先ごとに添付アップロード・Misskey投稿を並列実行）"""
+    logger.debug("🔍 メッセージ処理開始", extra={'job_id': job_id, 'message_id': payload['message_id']})
+    chunks = await render_text(job_id, payload['content'])
+    if config.sync_edits and len(payload.get('parts', [])) > 1:
+        record_note_parts(payload['message_id'], payload['parts'])
+    
+    results = payload.setdefault('destinations', {})
+    destinations = destinations_for_channel(payload['channel_id'])
+    # 複数投稿先に対応する前に積まれたジョブは、アップロード済みの結果を既定の投稿先に引き継ぐ
+    if 'media_ids' in payload and destinations:
+        results.setdefault(destinations[0].name, {'media_ids': payload.pop('media_ids')})
+    pending = [dest for dest in destinations if not results.get(dest.name, {}).get('note_id')]
+    logger.debug("📎 添付ファイル数: %d, 投稿先: %s", len(payload['attachments']), [dest.name for dest in pending],
+                 extra={'job_id': job_id})
+    
+    # 投稿先ごとに独立して処理し、1つの失敗が他の投稿先を止めないようにする
+    prepared = {}
+    outcomes = await asyncio.gather(
+        *(post_to_destination(job_id, dest, chunks, payload, prepared) for dest in pending),
+        return_exceptions=True,
+    )
+    failed = [dest.name for dest, outcome in zip(pending, outcomes) if isinstance(outcome, BaseException)]
+    for dest, outcome in zip(pending, outcomes):
+        if isinstance(outcome, BaseException) and not isinstance(outcome, RuntimeError):
+            logger.error("❌ 投稿先 %s の処理エラー: %s: %s", dest.name, type(outcome).__name__, outcome,
+                         extra={'job_id': job_id, 'destination': dest.name})
+    if failed:
+        # 成功した投稿先は記録済みなので、再試行では失敗した投稿先だけを処理する
+        raise RuntimeError(f"Misskey投稿失敗: {', '.join(failed)}")
+    
+    global last_post_at
+    last_post_at = time.time()
+    message_counts['posted'] += 1
+
+async def delete_note(dest: MisskeyClient, note_id: str):
+    """ノートを削除（既に削除されていれば何もしない）"""
+    try:
+        await dest.request('notes/delete', {'noteId': note_id})
+    except MisskeyAPIError as e:
+        if e.status not in (400, 404):
+            raise
+
+async def delete_notes(dest: MisskeyClient, note_ids: list[str]):
+    """返信のチェーンを後ろから順に削除"""
+    for note_id in reversed(note_ids):
+        await delete_note(dest, note_id)
+
+async def update_note(dest: MisskeyClient, note_ids: list[str], chunks: list[str], media_ids: list[str], media_changed: bool) -> list[str]:
+    """ノート（分割した場合は返信も）を編集し、ノートIDを返す（編集できない場合は作り直して新しいIDを返す）"""
+    # 分割数が変わった場合も、返信のつながりを保つために作り直す
+    if dest.supports_note_update and not media_changed and len(note_ids) == len(chunks):
+        try:
+            for note_id, chunk in zip(note_ids, chunks):
+                await dest.request(config.note_edit_endpoint, {'noteId': note_id, 'text': chunk, 'cw': None})
+            return note_ids
+        except MisskeyAPIError as e:
+            if e.status not in (400, 404):
+                raise
+            if e.status == 404:
+                # エンドポイント自体がないインスタンスでは、以降は最初から作り直す
+                dest.supports_note_update = False
+            logger.info("✏️ ノートを編集できないため作り直します: %s", e, extra={'destination': dest.name, 'note_id': note_ids[0]})
+    await delete_notes(dest, note_ids)
+    new_ids = []
+    try:
+        await post_thread(dest, chunks, media_ids, new_ids)
+    except RuntimeError as e:
+        # 途中まで投稿したチェーンは残さない（再試行で最初から作り直す）
+        await delete_notes(dest, new_ids)
+        if isinstance(e, MediaRejectedError):
+            raise
+        raise RuntimeError(f"ノートの作り直しに失敗 ({dest.name})")
+    return new_ids
+
+async def process_edit_job(job_id: int, payload: dict):
+    """編集ジョブを処理（投稿先ごとにノートを編集）"""
+    message_id = payload['message_id']
+    # 投稿がまだ終わっていない投稿先があれば、終わってから反映する
+    if find_create_job(message_id) is not None:
+        raise RuntimeError("投稿が完了していないため、編集の反映を後で再試行します")
+    
+    chunks = await render_text(job_id, payload['content'])
+    text = '\n'.join(chunks)
+    digest = text_digest(text)
+    attachment_ids = [att['id'] for att in payload['attachments']]
+    prepared = {}
+    
+    async def edit(dest: MisskeyClient, note: dict) -> bool:
+        # 後から届いた古い編集や、内容が変わらない更新（リンクの埋め込み展開など）は反映しない
+        if note['edited_at'] and payload['edited_at'] <= note['edited_at']:
+            return False
+        media_changed = note['attachment_ids'] != attachment_ids
+        if note['text_md5'] == digest and not media_changed:
+            return False
+        # 添付ファイルが変わらない場合は、以前の投稿で使ったファイルを再利用する
+        media_ids = reused = note['media_ids']
+        if media_changed:
+            reused = set()
+            media_ids = await upload_attachments(dest, payload['attachments'], prepared, reused)
+        old_ids = [note['note_id'], *note['reply_ids']]
+        try:
+            note_ids = await update_note(dest, old_ids, chunks, media_ids, media_changed)
+        except MediaRejectedError:
+            reuploaded = await reupload_rejected_media(dest, list(reused), payload['attachments'], prepared, set())
+            if reuploaded is None:
+                raise
+            media_ids = reuploaded
+            note_ids = await update_note(dest, old_ids, chunks, media_ids, True)
+        record_note(message_id, dest, note_ids, text, media_ids, attachment_ids, payload['edited_at'])
+        logger.info("✏️ ノートに編集を反映しました: %s", note_ids[0], extra={'job_id': job_id, 'destination': dest.name})
+        return True
+    
+    targets = [(misskey_clients[name], note) for name, note in lookup_notes(message_id).items() if name in misskey_clients]
+    outcomes = await asyncio.gather(*(edit(dest, note) for dest, note in targets), return_exceptions=True)
+    failed = [dest.name for (dest, _), outcome in zip(targets, outcomes) if isinstance(outcome, BaseException)]
+    if failed:
+        raise RuntimeError(f"編集の反映に失敗: {', '.join(failed)}")
+    if any(outcomes):
+        message_counts['edited'] += 1
+
+async def process_delete_job(job_id: int, payload: dict):
+    """削除ジョブを処理（投稿先ごとにノートを削除）"""
+    message_id = payload['message_id']
+    # 一部の投稿先にだけ投稿して再試行待ちの投稿ジョブは取り消す（処理中なら終わるのを待つ）
+    cancel_pending_create(message_id, started=True)
+    if find_create_job(message_id) is not None:
+        raise RuntimeError("投稿の処理中のため、削除の反映を後で再試行します")
+    
+    async def delete(dest: MisskeyClient, note: dict):
+        await delete_notes(dest, [note['note_id'], *note['reply_ids']])
+        forget_note(message_id, dest)
+        logger.info("🗑️ ノートを削除しました: %s", note['note_id'], extra={'job_id': job_id, 'destination': dest.name})
+    
+    targets = [(misskey_clients[name], note) for name, note in lookup_notes(message_id).items() if name in misskey_clients]
+    outcomes = await asyncio.gather(*(delete(dest, note) for dest, note in targets), return_exceptions=True)
+    failed = [dest.name for (dest, _), outcome in zip(targets, outcomes) if isinstance(outcome, BaseException)]
+    if failed:
+        raise RuntimeError(f"削除の反映に失敗: {', '.join(failed)}")
+    message_counts['deleted'] += 1
+
+JOB_HANDLERS = {
+    'create': process_create_job,
+    'edit': process_edit_job,
+    'delete': process_delete_job,
+}
+
+async def process_job(job_id: int, payload: dict):
+    """ジョブ1件を種類に応じて処理"""
+    await JOB_HANDLERS[payload.get('kind', 'create')](job_id, payload)
+
+async def queue_worker(worker_id: int):
+    """キューからジョブを取り出して処理し続けるワーカー"""
+    while not queue_stopping:
+        queue_wakeup.clear()
+        prune_state_periodically()
+        job = claim_job()
+        if job is None:
+            try:
+                await asyncio.wait_for(queue_wakeup.wait(), timeout=config.queue_poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        
+        job_id, payload, attempts = job
+        # 処理中はリースを延長し続ける（期限切れで他のワーカーが同じジョブを二重に処理しないように）
+        lease = asyncio.create_task(keep_job_lease(job_id))
+        try:
+            with stage_latency.time('job'):
+                await process_job(job_id, payload)
+        except asyncio.CancelledError:
+            lease.cancel()
+            release_job(job_id)
+            raise
+        except Exception as e:
+            lease.cancel()
+            logger.error("❌ ジョブ処理エラー: %s", e, extra={'worker': worker_id, 'job_id': job_id})
+            fail_job(job_id, attempts, e)
+        else:
+            lease.cancel()
+            complete_job(job_id)
+            logger.info("✅ ジョブ完了", extra={'worker': worker_id, 'job_id': job_id, 'message_id': payload['message_id']})
+
+def start_queue_workers():
+    """ワーカーを起動（前回残ったジョブも再開）"""
+    global queue_stopping
+    queue_stopping = False
+    # シャードごとのプロセスは同じキューを共有するので、他のプロセスの処理中ジョブは戻さない
+    # （`shards` コマンドが起動前に戻し、途中で落ちたプロセスの分はリース切れで再取得する）
+    resumed = requeue_stale_jobs() if not config.shard_ids else 0
+    pending = count_pending_jobs()
+    if pending:
+        logger.info("📦 未完了のジョブを再開します: %d件（うち処理中だったもの %d件）", pending, resumed)
+    for i in range(config.queue_workers):
+        worker_tasks.append(asyncio.create_task(queue_worker(i + 1)))
+    logger.info("👷 キューワーカーを%d個起動しました", config.queue_workers)
+
+async def stop_queue_workers():
+    """新規ジョブの取得を止め、処理中のジョブを待ってからワーカーを停止"""
+    global queue_stopping
+    queue_stopping = True
+    queue_wakeup.set()
+    if not worker_tasks:
+        return
+    _, still_running = await asyncio.wait(worker_tasks, timeout=config.queue_shutdown_timeout)
+    for task in still_running:
+        task.cancel()
+    await asyncio.gather(*worker_tasks, return_exceptions=True)
+    worker_tasks.clear()
+    logger.info("👷 キューワーカーを停止しました")
+
+# ===== 停止中のメッセージの取り込み（バックフィル） =====
+# 起動時に記録した停止中の範囲（前回の取り込み済み位置〜常駐側が最初に受け取ったメッセージ）を
+# channel.history() で古い順にたどり、常駐時と同じジョブキューに積む。
+# 積むたびに範囲の位置を記録するので、中断しても続きから再開できる。
+
+backfill_stats = {'enqueued': 0, 'duplicates': 0, 'skipped': 0}
+backfill_task: asyncio.Task | None = None
+
+def owns_guild(guild_id: int | None) -> bool:
+    """このプロセスが担当するシャードのギルドか（DMはシャード0）"""
+    if not config.shard_ids:
+        return True
+    return ((guild_id or 0) >> 22) % config.shard_count in config.shard_ids
+
+def is_own_post(message: discord.Message) -> bool:
+    """自分の（Botでない）空でない投稿か"""
+    return (message.author.id in config.my_user_ids and not message.author.bot
+            and bool(message.content or message.attachments))
+
+async def backfill_channel(channel_id: int, bucket: TokenBucket):
+    """1チャンネル分の停止中の範囲のメッセージをキューに積む"""
+    # 取り込み済み位置が未記録なら範囲もない（以前のBotで投稿済みかもしれないので遡らず、最初のメッセージを受け取った時点から記録する）
+    gaps = get_db().execute(
+        "SELECT id, after_id, before_id FROM backfill_gaps WHERE channel_id = ? ORDER BY after_id", (channel_id,)
+    ).fetchall()
+    if not gaps:
+        logger.info("⏭️ 取りこぼした範囲がないためバックフィルしません", extra={'channel_id': channel_id})
+        return
+    
+    channel = client.get_channel(channel_id) or await client.fetch_channel(channel_id)
+    guild = getattr(channel, 'guild', None)
+    if not owns_guild(guild.id if guild else None):
+        logger.debug("⏭️ 他のプロセスが担当するシャードのためバックフィルしません", extra={'channel_id': channel_id})
+        return
+    started = time.perf_counter()
+    enqueued = 0
+    for gap_id, after, before in gaps:
+        enqueued += await backfill_gap(channel, gap_id, after, before, bucket)
+    logger.info("📚 バックフィル完了: %d件をキューに追加", enqueued,
+                extra={'channel_id': channel_id, 'elapsed_s': round(time.perf_counter() - started, 3)})
+
+async def backfill_gap(channel, gap_id: int, after: int, before: int | None, bucket: TokenBucket) -> int:
+    """停止中の範囲1つ分のメッセージをキューに積み、積んだ件数を返す（済んだ範囲の記録は消す）"""
+    if config.backfill_max_age_days > 0:
+        oldest = discord.utils.time_snowflake(datetime.now(timezone.utc) - timedelta(days=config.backfill_max_age_days))
+        after = max(after, oldest)
+    enqueued = 0
+    skipped = 0
+    if before is None or before > after:
+        history = channel.history(limit=None, after=discord.Object(id=after),
+                                  before=discord.Object(id=before) if before is not None else None, oldest_first=True)
+        async for message in history:
+            # 範囲の終わりが未定なら、常駐側がメッセージを受け取り始めた時点で打ち切る（そこから先は取り込み済み）
+            if before is None:
+                before = get_db().execute("SELECT before_id FROM backfill_gaps WHERE id = ?", (gap_id,)).fetchone()[0]
+                if before is not None and message.id >= before:
+                    break
+            if not is_own_post(message):
+                backfill_stats['skipped'] += 1
+                skipped += 1
+                # 対象外のメッセージが続く場合も、履歴1ページ分ごとに位置を記録しておく
+                if skipped % 100 == 0:
+                    advance_backfill_gap(gap_id, message.id)
+                continue
+            # ワーカーが追いつくまで待ち、キューを溜め込まない
+            while count_pending_jobs() >= config.backfill_max_pending:
+                await asyncio.sleep(config.queue_poll_interval)
+            await bucket.acquire()
+            if enqueue_message(message, gap_id=gap_id) is None:
+                backfill_stats['duplicates'] += 1
+                continue
+            backfill_stats['enqueued'] += 1
+            enqueued += 1
+    # 最後まで取り込んだ範囲の記録は消す（終わりが未定の範囲も、現時点までは取り込み済み）
+    get_db().execute("DELETE FROM backfill_gaps WHERE id = ?", (gap_id,))
+    return enqueued
+
+async def run_backfill():
+    """監視対象の全チャンネルをバックフィル（同時に遡るチャンネル数・積む速度を制限）"""
+    bucket = TokenBucket(config.backfill_rate, max(1, int(config.backfill_rate)))
+    semaphore = asyncio.Semaphore(config.backfill_concurrency)
+    
+    async def run(channel_id: int):
+        async with semaphore:
+            try:
+                await backfill_channel(channel_id, bucket)
+            except discord.DiscordException as e:
+                # 失敗した範囲は記録を残し、次のバックフィルで続きから取り込む
+                logger.error("❌ バックフィル失敗: %s", e, extra={'channel_id': channel_id})
+    
+    logger.info("📚 バックフィルを開始します（チャンネル数: %d）", len(config.target_channel_ids))
+    await asyncio.gather(*(run(channel_id) for channel_id in config.target_channel_ids))
+    logger.info("📚 バックフィルが完了しました", extra={'backfill': backfill_stats})
+
+async def backfill_and_exit():
+    """バックフィルして、積んだジョブを処理し終えたら終了"""
+    await run_backfill()
+    while count_pending_jobs():
+        await asyncio.sleep(config.queue_poll_interval)
+    await client.close()
+
+# ===== メトリクス・ヘルスチェック用HTTPサーバー =====
+
+metrics_runner: web.AppRunner | None = None
+
+async def handle_healthz(request: web.Request) -> web.Response:
+    """ゲートウェイ接続状態・キュー滞留数・最終投稿時刻を返す"""
+    connected = client.is_ready() and not client.is_closed()
+    body = {
+        'status': 'ok' if connected else 'degraded',
+        'gateway_connected': connected,
+        'queue_depth': count_pending_jobs(),
+        'last_post_at': datetime.fromtimestamp(last_post_at, timezone.utc).isoformat() if last_post_at else None,
+        'seconds_since_last_post': round(time.time() - last_post_at, 1) if last_post_at else None,
+        'shard_ids': sorted(client.shards) if config.shard_count else None,
+    }
+    from aiohttp import web
+    return web.json_response(body, status=200 if connected else 503)
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    """Prometheusのテキスト形式でメトリクスを返す"""
+    connected = client.is_ready() and not client.is_closed()
+    lines = stage_latency.render()
+    lines += render_counter('crosspost_messages_total', '処理したメッセージ数（結果別）', 'result', message_counts)
+    lines += [
+        "# HELP crosspost_misskey_requests_total Misskey API呼び出し数（投稿先・結果別）",
+        "# TYPE crosspost_misskey_requests_total counter",
+    ]
+    lines += [
+        f'crosspost_misskey_requests_total{{destination="{escape_label(dest.name)}",kind="{kind}"}} {count}'
+        for dest in misskey_clients.values()
+        for kind, count in dest.stats.items()
+    ]
+    lines += render_counter('crosspost_backfill_messages_total', 'バックフィルで処理したメッセージ数（結果別）', 'result', backfill_stats)
+    lines += render_counter('crosspost_link_preview_total', 'リンクプレビューの取得結果', 'result', link_preview_stats)
+    lines += render_counter('crosspost_drive_dedup_total', 'Driveアップロードの重複排除の結果', 'result', drive_dedup_stats)
+    # 件数とバイト数は単位が違うので、別のメトリクスにする
+    lines += render_counter('crosspost_media_total', '画像変換の結果', 'kind', {
+        kind: count for kind, count in media_stats.items() if not kind.startswith('bytes_')
+    })
+    lines += render_counter('crosspost_media_bytes_total', '画像変換の入出力バイト数', 'direction', {
+        'in': media_stats['bytes_in'], 'out': media_stats['bytes_out'],
+    })
+    lines += render_counter('crosspost_cache_events_total', 'キャッシュのヒット・ミス数', 'event', {
+        f"{cache.name}_{event}": count
+        for cache in (youtube_info_cache, youtube_thumbnail_cache, link_preview_cache)
+        for event, count in cache.stats.items()
+    })
+    lines += [
+        "# HELP crosspost_queue_depth 未完了のジョブ数",
+        "# TYPE crosspost_queue_depth gauge",
+        f"crosspost_queue_depth {count_pending_jobs()}",
+        "# HELP crosspost_gateway_connected Discordゲートウェイに接続しているか",
+        "# TYPE crosspost_gateway_connected gauge",
+        f"crosspost_gateway_connected {int(connected)}",
+        "# HELP crosspost_last_post_timestamp_seconds 最後に投稿に成功した時刻",
+        "# TYPE crosspost_last_post_timestamp_seconds gauge",
+        f"crosspost_last_post_timestamp_seconds {last_post_at or 0}",
+    ]
+    lines += render_counter('crosspost_startup_seconds', '起動時の各段階にかかった秒数', 'stage', startup_timings, metric_type='gauge')
+    from aiohttp import web
+    return web.Response(text='\n'.join(lines) + '\n', content_type='text/plain', charset='utf-8')
+
+async def start_metrics_server():
+    """/healthz と /metrics を提供するHTTPサーバーを起動"""
+    global metrics_runner
+    if not config.metrics_port:
+        return
+    # aiohttp.web（サーバー側）はBot本体では使わないので、ここで初めて読み込む
+    from aiohttp import web
+    app = web.Application()
+    app.router.add_get('/healthz', handle_healthz)
+    app.router.add_get('/metrics', handle_metrics)
+    metrics_runner = web.AppRunner(app, access_log=None)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, config.metrics_host, config.metrics_port).start()
+    logger.info("📈 メトリクスサーバーを起動しました: http://%s:%d/metrics", config.metrics_host, config.metrics_port)
+
+async def stop_metrics_server():
+    """メトリクスサーバーを停止"""
+    global metrics_runner
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+
+@client.event
+async def setup_hook():
+    mark_startup('login')
+    # 起動時に共有HTTPセッションを作成（以降の投稿で接続を再利用）
+    await get_http_session()
+    # メッセージを受け取り始める前に、停止中の範囲を記録しておく
+    open_backfill_gaps()
+    start_queue_workers()
+    if not BACKFILL_ONLY:
+        await start_metrics_server()
+    mark_startup('setup')
 
 @client.event
 async def on_ready():
-    print(f'✅ Discord Botにログインしました: {client.user}')
-    print(f'🔍 監視を開始しています...')
+    global backfill_task
+    logger.info("✅ Discord Botにログインしました: %s 監視を開始しています", client.user)
+    if 'gateway' not in startup_timings:
+        mark_startup('gateway')
+        logger.info("⏱️ 起動完了までの時間: %.2f秒", time.perf_counter() - STARTUP_STARTED, extra={'startup': startup_timings})
+    # 再接続でも on_ready は呼ばれるので、バックフィルは1回だけ
+    if backfill_task is None and (config.backfill_on_start or BACKFILL_ONLY):
+        backfill_task = asyncio.create_task(backfill_and_exit() if BACKFILL_ONLY else run_backfill())
 
 @client.event
 async def on_message(message: discord.Message):
-    print(f"🔍 ===== on_messageイベント開始 =====")
-    print(f"🔍 メッセージID: {message.id}")
-    print(f"🔍 チャンネルID: {message.channel.id}")
-    print(f"🔍 チャンネル名: {message.channel.name}")
-    print(f"🔍 ユーザーID: {message.author.id}")
-    print(f"🔍 ユーザー名: {message.author.name}")
-    print(f"🔍 ユーザーがBotか: {message.author.bot}")
-    print(f"🔍 メッセージ内容: {repr(message.content)}")
-    print(f"🔍 添付ファイル数: {len(message.attachments)}")
-    print(f"🔍 環境変数TARGET_CHANNEL_IDS: {TARGET_CHANNEL_IDS}")
-    print(f"🔍 環境変数MY_USER_ID: {MY_USER_ID}")
-    
-    # 対象チャンネルのみ
-    if message.channel.id not in TARGET_CHANNEL_IDS:
-        print(f"🔍 ❌ 対象チャンネルではありません: {message.channel.id} not in {TARGET_CHANNEL_IDS}")
+    # 対象チャンネル・自分の投稿以外は、ログの整形も含めて何もせずに捨てる
+    # （監視していないチャンネルのメッセージも全てここを通るため、最初に判定する）
+    if message.channel.id not in config.target_channel_ids:
+        message_counts['skipped'] += 1
         return
-    print(f"🔍 ✅ 対象チャンネルです: {message.channel.id}")
-    
-    # 自分の投稿のみ
-    if message.author.id != MY_USER_ID:
-        print(f"🔍 ❌ 対象ユーザーではありません: {message.author.id} != {MY_USER_ID}")
+    # 自分以外・Botの投稿と空メッセージは除外
+    if not is_own_post(message):
+        message_counts['skipped'] += 1
         return
-    print(f"🔍 ✅ 対象ユーザーです: {message.author.id}")
     
-    # Botや空メッセージは除外
-    if message.author.bot:
-        print(f"🔍 ❌ Botの投稿です: {message.author.bot}")
+    # キューに積むだけで、投稿処理はワーカーに任せる（バックフィルで積み済みなら何もしない）
+    job_id = enqueue_message(message)
+    if job_id is None:
+        return
+    logger.info("📦 ジョブをキューに追加しました", extra={'job_id': job_id, 'message_id': message.id, 'channel_id': message.channel.id})
+
+def enqueue_delete(message_id: int, channel_id: int):
+    """削除されたメッセージのノートを削除するジョブを積む"""
+    # まだ投稿していなければ、投稿ジョブを取り消すだけ
+    if cancel_pending_create(message_id):
+        logger.info("🗑️ 投稿前に削除されたため投稿を取り消しました", extra={'message_id': message_id})
+        return
+    # まとめて投稿したメッセージなら、残りのメッセージでノートを編集する
+    job = regroup_note_parts(message_id, channel_id, None)
+    if job is None:
+        if not lookup_notes(message_id) and find_create_job(message_id) is None:
+            return
+        job = {'kind': 'delete', 'message_id': message_id, 'channel_id': channel_id}
+    job_id = enqueue_job(job)
+    logger.info("📦 %sジョブをキューに追加しました", '削除' if job['kind'] == 'delete' else '編集',
+                extra={'job_id': job_id, 'message_id': message_id})
+
+@client.event
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+    # キャッシュにない古いメッセージの編集も受け取れるよう、rawイベントを使う
+    if not config.sync_edits or payload.channel_id not in config.target_channel_ids:
+        return
+    message = payload.message
+    if not is_own_post(message):
+        return
+    # 内容が変わっていない更新（リンクの埋め込み展開など）は無視
+    before = payload.cached_message
+    if (before is not None and before.content == message.content
+            and [att.id for att in before.attachments] == [att.id for att in message.attachments]):
         return
-    print(f"🔍 ✅ ユーザーの投稿です")
     
-    if not (message.content or message.attachments):
-        print(f"🔍 ❌ 空のメッセージです")
+    job = message_to_job(message)
+    # まだ投稿していなければ、投稿ジョブの内容を差し替えるだけ
+    if replace_pending_create(job):
+        logger.info("✏️ 投稿前に編集されたため内容を差し替えました", extra={'message_id': message.id})
+        return
+    job['kind'] = 'edit'
+    job['edited_at'] = (message.edited_at or discord.utils.utcnow()).timestamp()
+    # まとめて投稿したメッセージなら、まとめた全体でノートを編集する
+    job = regroup_note_parts(message.id, message.channel.id, job) or job
+    if job['message_id'] == message.id and not lookup_notes(message.id) and find_create_job(message.id) is None:
         return
-    print(f"🔍 ✅ メッセージ内容があります")
+    job_id = enqueue_job(job)
+    logger.info("📦 編集ジョブをキューに追加しました", extra={'job_id': job_id, 'message_id': message.id})
+
+@client.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    if config.sync_edits and payload.channel_id in config.target_channel_ids:
+        enqueue_delete(payload.message_id, payload.channel_id)
+
+@client.event
+async def on_raw_bulk_message_delete(payload: discord.RawBulkMessageDeleteEvent):
+    if config.sync_edits and payload.channel_id in config.target_channel_ids:
+        for message_id in payload.message_ids:
+            enqueue_delete(message_id, payload.channel_id)
+
+async def main():
+    """Botを起動し、終了時に共有リソースを解放"""
+    try:
+        async with client:
+            await client.start(config.discord_bot_token)
+    finally:
+        if backfill_task is not None:
+            backfill_task.cancel()
+            await asyncio.gather(backfill_task, return_exceptions=True)
+        await stop_metrics_server()
+        await stop_queue_workers()
+        logger.info("📊 統計", extra={
+            'messages': message_counts,
+            'backfill': backfill_stats,
+            'misskey': {name: dest.stats for name, dest in misskey_clients.items()},
+            'youtube_info_cache': youtube_info_cache.stats,
+            'youtube_thumbnail_cache': youtube_thumbnail_cache.stats,
+            'link_preview_cache': link_preview_cache.stats,
+            'link_preview': link_preview_stats,
+            'youtube_batcher': youtube_batcher.stats,
+            'drive_dedup': drive_dedup_stats,
+            'media': media_stats,
+        })
+        shutdown_media_executor()
+        await close_misskey_clients()
+        await close_http_session()
+        close_db()
+
+# ===== シャードごとのプロセス起動 =====
+
+SHARD_RESTART_DELAY = 5  # 落ちたプロセスを起動し直すまでの秒数
+
+def run_shard_processes():
+    """シャードを SHARD_PROCESSES 個のプロセスに分けて起動し、落ちたプロセスは起動し直す"""
+    import signal
+    import subprocess
     
-    print(f"🔍 ===== メッセージ処理開始 =====")
+    if not config.shard_count:
+        logger.error("❌ `shards` で起動するには SHARD_COUNT を指定してください")
+        exit(1)
+    processes = max(1, min(config.shard_processes, config.shard_count))
+    # 子プロセスは互いの処理中ジョブを戻さないので、前回の残りは起動前にまとめて戻しておく
+    resumed = requeue_stale_jobs()
+    close_db()
+    if resumed:
+        logger.info("📦 処理中のまま残っていたジョブを%d件戻しました", resumed)
     
-    # YouTubeリンクの検出
-    original_text = message.content or ''
-    print(f"🔍 元のテキスト: {repr(original_text)}")
-    print(f"🔍 テキスト長: {len(original_text)}")
+    children: dict[int, subprocess.Popen] = {}
+    restart_at: dict[int, float] = {}
+    stopping = False
     
-    video_id = extract_youtube_video_id(original_text)
-    print(f"🔍 抽出されたvideo_id: {video_id}")
-    print(f"🔍 video_idの型: {type(video_id)}")
+    def spawn(index: int):
+        shard_ids = list(range(index, config.shard_count, processes))
+        env = {**os.environ, 'SHARD_IDS': ','.join(map(str, shard_ids))}
+        if config.metrics_port:
+            # メトリクスはプロセスごとに別のポートで公開する
+            env['METRICS_PORT'] = str(config.metrics_port + index)
+        # 端末のCtrl+Cは親だけが受け取り、子には順に終了を伝える
+        children[index] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env, start_new_session=True)
+        logger.info("🧩 プロセス%dを起動しました（シャード: %s）", index, shard_ids, extra={'pid': children[index].pid})
     
-    if video_id:
-        print(f"🎬 YouTube動画検出: {video_id}")
-
-    # テキストをカスタマイズ（Misskeyの自動埋め込みを回避）
-    print(f"🔍 元のテキスト: {repr(original_text)}")
-    text = await customize_youtube_display(original_text, video_id)
-    print(f"🔍 カスタマイズ後: {repr(text)}")
-    text = truncate_for_misskey(text)
-    print(f"🔍 最終テキスト: {repr(text)}")
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        # SIGINTならBot側で処理中のジョブを待ってから終了する
+        for child in children.values():
+            child.send_signal(signal.SIGINT)
     
-    # 添付ファイルの処理（任意）
-    media_ids = []
-    print(f"📎 添付ファイル数: {len(message.attachments)}")
-    for i, att in enumerate(message.attachments):
-        try:
-            print(f"📁 ファイル {i+1}: {att.filename} ({att.size} bytes)")
-            
-            # ファイルを読み込み
-            file_bytes = await att.read()
-            print(f"📥 ファイル読み込み完了: {len(file_bytes)} bytes")
-            
-            # MisskeyのDriveにアップロード
-            async with aiohttp.ClientSession() as session:
-                data = aiohttp.FormData()
-                data.add_field('i', MISSKEY_TOKEN)
-                data.add_field('file', file_bytes, filename=att.filename)
-                
-                async with session.post(
-                    f'{MISSKEY_HOST}/api/drive/files/create',
-                    data=data
-                ) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        media_id = result.get('id')
-                        if media_id:
-                            media_ids.append(media_id)
-                            print(f"✅ ファイルアップロード成功: {att.filename} -> ID: {media_id}")
-                        else:
-                            print(f"❌ ファイルアップロード失敗: IDが見つかりません - {result}")
-                    else:
-                        error_text = await response.text()
-                        print(f"❌ ファイルアップロード失敗: {response.status} - {error_text}")
-                        
-        except Exception as e:
-            print(f"❌ ファイル処理エラー ({att.filename}): {e}")
-            import traceback
-            traceback.print_exc()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(processes):
+        spawn(index)
+    while children or (restart_at and not stopping):
+        time.sleep(1)
+        for index, child in list(children.items()):
+            if child.poll() is None:
+                continue
+            del children[index]
+            if not stopping:
+                logger.error("💥 プロセス%dが終了しました（終了コード %d）。%d秒後に起動し直します",
+                             index, child.returncode, SHARD_RESTART_DELAY)
+                restart_at[index] = time.monotonic() + SHARD_RESTART_DELAY
+        for index, at in list(restart_at.items()):
+            if not stopping and time.monotonic() >= at:
+                del restart_at[index]
+                spawn(index)
+    logger.info("👋 全てのプロセスを停止しました")
 
-    # Misskeyに投稿
-    if media_ids:
-        print(f"🖼️ 画像付きで投稿: {len(media_ids)}枚の画像")
-        print(f"📋 メディアID一覧: {media_ids}")
-    else:
-        print("📝 テキストのみ投稿")
-    
-    resp = await post_to_misskey(text, media_ids if media_ids else None)
-    try:
-        resp_text = await resp.text()
-        print(f'📤 Misskey投稿結果: {resp.status} - {resp_text}')
-    except Exception as e:
-        print(f'⚠️ レスポンス読み取りエラー: {e}')
-        print(f'📤 Misskey投稿結果: {resp.status} - レスポンス読み取り失敗')
+mark_startup('module')
 
 if __name__ == "__main__":
+    # `python discord_to_misskey.py backfill` なら取り込みだけ行って終了
+    # `python discord_to_misskey.py shards` ならシャードごとのプロセスを起動して見守る
+    command = sys.argv[1:2]
+    BACKFILL_ONLY = command == ['backfill']
+    
     # 環境変数の検証
     validate_environment()
+    mark_startup('validate')
     
     # Botを起動
-    print("🚀 Discord to Misskey Botを起動しています...")
-    client.run(DISCORD_BOT_TOKEN)
\ No newline at end of file
+    logger.info("🚀 Discord to Misskey Botを起動しています...")
+    try:
+        if command == ['shards']:
+            run_shard_processes()
+        else:
+            asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.info("👋 Botを停止しました")
+    finally:
+        shutdown_logging()